@@ -1,21 +1,37 @@
 import os
+import re
+import time
+import pickle
+import secrets
+import json
+import hashlib
+import inspect
 import socket
 import pandas as pd
 import numpy as np
-from flask import Flask, render_template, request, redirect, abort, url_for, g, session, send_file, send_from_directory
+from flask import Flask, render_template, request, redirect, abort, url_for, g, session, send_file, send_from_directory, jsonify, Response, stream_with_context
 from werkzeug.utils import secure_filename
+from markupsafe import escape
+import click
 from playwright.sync_api import sync_playwright
 import sqlite3
 import base64
 from PIL import Image, ExifTags
-import zipfile, tempfile
+import zipfile
+from collections import defaultdict, deque, namedtuple
 import io
+import atexit
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
 from io import BytesIO
 from openpyxl import load_workbook
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import Font, PatternFill, Alignment, Protection
-from datetime import datetime
-from weasyprint import HTML
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, unquote
+from pathlib import Path
+from weasyprint import HTML, default_url_fetcher
 
 app = Flask(__name__)
 
@@ -32,11 +48,56 @@ else:
 
 app.config['ALLOWED_EXTENSIONS'] = {'csv', 'xlsx'}
 
+# Batch report PDFs are rendered in process: 'playwright' (Chromium) or 'weasyprint'
+app.config['REPORT_RENDERER'] = os.environ.get('REPORT_RENDERER', 'playwright')
+# Synthetic origin report pages are loaded under; assets are served from disk, never over HTTP
+app.config['REPORT_ASSET_BASE_URL'] = 'http://reports.local/'
+# Reports printed at once per batch (Chromium pages or WeasyPrint processes)
+app.config['REPORT_RENDER_WORKERS'] = int(os.environ.get('REPORT_RENDER_WORKERS', min(4, os.cpu_count() or 1)))
+# Warm Chromium instances kept per worker process, and renders before each is relaunched
+app.config['REPORT_BROWSER_POOL_SIZE'] = int(os.environ.get('REPORT_BROWSER_POOL_SIZE', app.config['REPORT_RENDER_WORKERS']))
+app.config['REPORT_BROWSER_MAX_RENDERS'] = int(os.environ.get('REPORT_BROWSER_MAX_RENDERS', 200))
+# Class batches run as background jobs ('queue') or inside the request ('inline')
+app.config['REPORT_BATCH_MODE'] = os.environ.get('REPORT_BATCH_MODE', 'queue')
+app.config['REPORT_JOB_POLL_SECONDS'] = 5
+# A running job not heard from in this long lost its worker; it is requeued
+# until it has been started REPORT_JOB_MAX_ATTEMPTS times, then failed
+app.config['REPORT_JOB_STALE_SECONDS'] = int(os.environ.get('REPORT_JOB_STALE_SECONDS', 15 * 60))
+app.config['REPORT_JOB_MAX_ATTEMPTS'] = int(os.environ.get('REPORT_JOB_MAX_ATTEMPTS', 2))
+app.config['REPORT_OUTPUT_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'reports')
+# Rendered PDFs keyed by a hash of their inputs; least recently used are evicted past the limit
+app.config['REPORT_CACHE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'report_cache')
+app.config['REPORT_CACHE_MAX_BYTES'] = int(os.environ.get('REPORT_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+# Processes parsing the sheets of a multi-subject results workbook
+app.config['UPLOAD_PARSE_WORKERS'] = int(os.environ.get('UPLOAD_PARSE_WORKERS', min(4, os.cpu_count() or 1)))
+# Rows read, validated and saved at a time from uploaded spreadsheets
+app.config['UPLOAD_CHUNK_ROWS'] = int(os.environ.get('UPLOAD_CHUNK_ROWS', 5000))
+# Limits on a ZIP bundle of result files, checked before any entry is read
+app.config['UPLOAD_BUNDLE_MAX_FILES'] = int(os.environ.get('UPLOAD_BUNDLE_MAX_FILES', 60))
+app.config['UPLOAD_BUNDLE_MAX_FILE_BYTES'] = int(os.environ.get('UPLOAD_BUNDLE_MAX_FILE_BYTES', 10 * 1024 * 1024))
+app.config['UPLOAD_BUNDLE_MAX_BYTES'] = int(os.environ.get('UPLOAD_BUNDLE_MAX_BYTES', 100 * 1024 * 1024))
+# Parsed uploads kept between the preview page and its confirmation
+app.config['UPLOAD_PREVIEW_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'previews')
+app.config['UPLOAD_PREVIEW_TTL_SECONDS'] = int(os.environ.get('UPLOAD_PREVIEW_TTL_SECONDS', 3600))
+# JSS positions are across all arms of a class ('class'); 'arm' ranks within each arm
+app.config['REPORT_POSITION_SCOPE'] = os.environ.get('REPORT_POSITION_SCOPE', 'class')
+
 # app.config['DATABASE'] = 'school_results copy.db'
+# Applied to every new connection. WAL lets readers carry on during uploads, and
+# busy_timeout makes writers from other workers wait for the lock instead of failing
+app.config['DATABASE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': int(os.environ.get('DATABASE_BUSY_TIMEOUT_MS', 10000)),
+    'cache_size': -20000,        # KiB, i.e. 20 MB of page cache
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'school_result_secret_key')
 
 # Create necessary directories
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], "photos"), exist_ok=True)
+os.makedirs(app.config['REPORT_OUTPUT_FOLDER'], exist_ok=True)
     
 # def get_db():
 #     db = getattr(g, '_database', None)
@@ -45,24 +106,117 @@ os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], "photos"), exist_ok=True)
 #         db.row_factory = sqlite3.Row
 #     return db
 
+class ConnectionManager:
+    """SQLite connections opened with DATABASE_PRAGMAS and reused per thread.
+
+    Each thread keeps one connection per database file across requests.
+    When the last app context using it tears down, anything left
+    uncommitted is rolled back and counted as a leak. Connections of
+    threads that have exited are closed on the next open, and the rest at
+    process exit. Connections inherited across fork() are dropped, never
+    reused.
+    """
+
+    def __init__(self, pragmas):
+        self.pragmas = pragmas
+        self.opens = 0
+        self.reuses = 0
+        self.closes = 0
+        self.leaks = 0
+        self._connections = {}   # (pid, thread ident, database) -> [connection, users]
+        self._lock = threading.Lock()
+
+    def acquire(self, database):
+        key = (os.getpid(), threading.get_ident(), database)
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is not None:
+                entry[1] += 1
+                self.reuses += 1
+                return entry[0]
+            self._close_stale()
+
+        conn = self._connect(database)
+        with self._lock:
+            self._connections[key] = [conn, 1]
+            self.opens += 1
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            for key, entry in self._connections.items():
+                if entry[0] is conn and key[0] == os.getpid():
+                    entry[1] -= 1
+                    if entry[1] > 0:
+                        return
+                    break
+            else:
+                return
+            self._close_stale()
+        if conn.in_transaction:
+            conn.rollback()
+            with self._lock:
+                self.leaks += 1
+
+    def close_all(self):
+        with self._lock:
+            pid = os.getpid()
+            for key, entry in list(self._connections.items()):
+                if key[0] == pid:
+                    entry[0].close()
+                    self.closes += 1
+            self._connections.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'open': len(self._connections), 'opens': self.opens, 'reuses': self.reuses,
+                    'closes': self.closes, 'leaks': self.leaks}
+
+    def _connect(self, database):
+        # Only the owning thread uses a connection, but a stale one is closed by whichever thread notices
+        conn = sqlite3.connect(database, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        return conn
+
+    def _close_stale(self):
+        pid = os.getpid()
+        live = {thread.ident for thread in threading.enumerate()}
+        for key, entry in list(self._connections.items()):
+            if key[0] != pid:
+                del self._connections[key]
+            elif key[1] not in live:
+                entry[0].close()
+                self.closes += 1
+                del self._connections[key]
+
+db_connections = ConnectionManager(app.config['DATABASE_PRAGMAS'])
+atexit.register(db_connections.close_all)
+
 def get_db():
     if 'db' not in g:
         # os.makedirs(os.path.dirname(app.config['DATABASE']), exist_ok=True)
-        g.db = sqlite3.connect(app.config['DATABASE'])
-        g.db.row_factory = sqlite3.Row
+        g.db = db_connections.acquire(app.config['DATABASE'])
     return g.db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('db', None)
     if db is not None:
-        db.close()
+        db_connections.release(db)
 
 def init_db():
     with app.app_context():
         db = get_db()
         cursor = db.cursor()
 
+        # Fast start: with the schema and seed data unchanged since the last
+        # full run there is nothing to create or seed, and no write lock is taken
+        checksum = init_db_checksum()
+        if database_is_current(db, checksum):
+            return
+
         # Classes table
         cursor.execute('''CREATE TABLE IF NOT EXISTS classes (
                         id INTEGER PRIMARY KEY,
@@ -215,6 +369,137 @@ def init_db():
                 FOREIGN KEY (skill_id) REFERENCES skills(id)
             )''')
 
+        # Background report generation jobs (class_arm_id NULL = whole school)
+        cursor.execute('''CREATE TABLE IF NOT EXISTS report_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                class_arm_id INTEGER,
+                term INTEGER NOT NULL,
+                session TEXT NOT NULL,
+                report_type TEXT NOT NULL CHECK(report_type IN ('half_term', 'full_term')),
+                status TEXT NOT NULL DEFAULT 'queued' CHECK(status IN ('queued', 'running', 'done', 'failed')),
+                total INTEGER DEFAULT 0,
+                completed INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                errors TEXT,
+                output_path TEXT,
+                created_at TEXT NOT NULL,
+                started_at TEXT,
+                finished_at TEXT,
+                FOREIGN KEY (class_arm_id) REFERENCES class_arms (id)
+            )''')
+
+        # Report input change tracking: every write to a report input bumps
+        # the (student, term, session) revision; report_renders records the
+        # revision each student's last PDF was rendered from
+        cursor.execute('''CREATE TABLE IF NOT EXISTS report_input_revisions (
+                student_id INTEGER NOT NULL,
+                term INTEGER NOT NULL,
+                session TEXT NOT NULL,
+                revision INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (student_id, term, session),
+                FOREIGN KEY (student_id) REFERENCES students (id)
+            )''')
+
+        cursor.execute('''CREATE TABLE IF NOT EXISTS report_renders (
+                student_id INTEGER NOT NULL,
+                term INTEGER NOT NULL,
+                session TEXT NOT NULL,
+                report_type TEXT NOT NULL,
+                revision INTEGER NOT NULL,
+                fingerprint TEXT NOT NULL,
+                cache_key TEXT NOT NULL,
+                rendered_at TEXT NOT NULL,
+                PRIMARY KEY (student_id, term, session, report_type),
+                FOREIGN KEY (student_id) REFERENCES students (id)
+            )''')
+
+        for table in ('scores', 'student_assessments', 'attendance_summary', 'student_skills'):
+            for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+                # Plain INSERT ... WHERE NOT EXISTS: an outer INSERT OR REPLACE would
+                # turn an INSERT OR IGNORE in the trigger body into a REPLACE
+                cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_revision
+                    AFTER {event} ON {table}
+                    BEGIN
+                        INSERT INTO report_input_revisions (student_id, term, session)
+                        SELECT {row}.student_id, {row}.term, {row}.session
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM report_input_revisions
+                            WHERE student_id = {row}.student_id AND term = {row}.term AND session = {row}.session
+                        );
+                        UPDATE report_input_revisions SET revision = revision + 1
+                        WHERE student_id = {row}.student_id AND term = {row}.term AND session = {row}.session;
+                    END''')
+
+        # Biodata and photos appear on every report the student has
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS students_update_revision
+            AFTER UPDATE OF full_name, age, gender, photo, department_id ON students
+            BEGIN
+                UPDATE report_input_revisions SET revision = revision + 1 WHERE student_id = NEW.id;
+            END''')
+
+        # Stored positions per ranking scope ('class' = all arms of a class,
+        # 'arm' = one class arm) and (term, session, report_type); a scope's
+        # rows are dropped whenever its scores or enrolment change and rebuilt
+        # on the next read that finds no ranking_builds marker for it
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS class_rankings ({CLASS_RANKINGS_COLUMNS})")
+
+        # Per-subject positions and statistics, stored and invalidated the same way
+        cursor.execute('''CREATE TABLE IF NOT EXISTS subject_rankings (
+                scope TEXT NOT NULL CHECK(scope IN ('class', 'arm')),
+                scope_id INTEGER NOT NULL,
+                term INTEGER NOT NULL,
+                session TEXT NOT NULL,
+                report_type TEXT NOT NULL,
+                subject_id INTEGER NOT NULL,
+                student_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                highest REAL NOT NULL,
+                lowest REAL NOT NULL,
+                average REAL NOT NULL,
+                student_count INTEGER NOT NULL,
+                PRIMARY KEY (scope, scope_id, term, session, report_type, subject_id, student_id),
+                FOREIGN KEY (subject_id) REFERENCES subjects (id),
+                FOREIGN KEY (student_id) REFERENCES students (id)
+            )''')
+
+        # The triggers that drop stale rankings are created by migration 5
+
+        # Roster change tracking for the cached student name indexes: any
+        # enrolment change or rename bumps the (class arm, session) revision
+        cursor.execute('''CREATE TABLE IF NOT EXISTS roster_revisions (
+                class_arm_id INTEGER NOT NULL,
+                session TEXT NOT NULL,
+                revision INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (class_arm_id, session)
+            )''')
+        cursor.execute('''INSERT OR IGNORE INTO roster_revisions (class_arm_id, session)
+            SELECT DISTINCT class_arm_id, session FROM student_classes''')
+
+        for event, rows in (('INSERT', ('NEW',)), ('UPDATE', ('OLD', 'NEW')), ('DELETE', ('OLD',))):
+            bump = "".join(f'''
+                    INSERT INTO roster_revisions (class_arm_id, session)
+                    SELECT {row}.class_arm_id, {row}.session
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM roster_revisions
+                        WHERE class_arm_id = {row}.class_arm_id AND session = {row}.session
+                    );
+                    UPDATE roster_revisions SET revision = revision + 1
+                    WHERE class_arm_id = {row}.class_arm_id AND session = {row}.session;''' for row in rows)
+            cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS student_classes_{event.lower()}_roster
+                AFTER {event} ON student_classes
+                BEGIN{bump}
+                END''')
+
+        for event, trigger_event, row in (('update', 'UPDATE OF full_name', 'NEW'), ('delete', 'DELETE', 'OLD')):
+            cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS students_{event}_roster
+                AFTER {trigger_event} ON students
+                BEGIN
+                    UPDATE roster_revisions SET revision = revision + 1
+                    WHERE (class_arm_id, session) IN (
+                        SELECT class_arm_id, session FROM student_classes WHERE student_id = {row}.id
+                    );
+                END''')
+
         skills = [
             "Coding",
             "Photography",
@@ -318,57 +603,370 @@ def init_db():
 
         db.commit()
 
-        # 4. VERIFY THE DATA WAS INSERTED CORRECTLY
+        # Schema changes beyond the tables above are versioned migrations;
+        # the hot query plans are printed whenever one is applied
+        migrate_db(db, explain=True)
+
+        # Remember what was seeded so the next start can skip all of the above
+        cursor.execute("""CREATE TABLE IF NOT EXISTS seed_state (
+                        name TEXT PRIMARY KEY,
+                        checksum TEXT NOT NULL,
+                        seeded_at TEXT NOT NULL)""")
+        cursor.execute("INSERT OR REPLACE INTO seed_state (name, checksum, seeded_at) VALUES ('init_db', ?, ?)",
+                       (checksum, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        db.commit()
         print("=== Database Initialization Complete ===")
 
-        # Check Classes
-        cursor.execute("SELECT id, name, level FROM classes")
-        print("Classes:")
-        for row in cursor.fetchall():
-            print(f"ID: {row['id']}, Name: {row['name']}, Level: {row['level']}")
-
-        # Check Class Arms
-        cursor.execute("SELECT id, class_id, arm FROM class_arms")
-        print("\nClass Arms:")
-        for row in cursor.fetchall():
-            print(f"Arm ID: {row['id']}, Class ID: {row['class_id']}, Arm: {row['arm']}")
-
-        # Check Departments
-        cursor.execute("SELECT id, name, level FROM departments")
-        print("\nDepartments:")
-        for row in cursor.fetchall():
-            print(f"Dept ID: {row['id']}, Name: {row['name']}, Level: {row['level']}")
-
-        # Check Subjects
-        cursor.execute("SELECT id, name, level, is_common_core FROM subjects ORDER BY level, name")
-        print("\nSubjects:")
-        for row in cursor.fetchall():
-            print(f"Subject ID: {row['id']}, Name: {row['name']}, Level: {row['level']}, Common Core: {row['is_common_core']}")
-
-        # Check Department-Subject relationships
-        cursor.execute("""
-            SELECT d.name as dept_name, s.name as subject_name, ds.is_compulsory
-            FROM department_subjects ds
-            JOIN departments d ON ds.department_id = d.id
-            JOIN subjects s ON ds.subject_id = s.id
-            ORDER BY d.name, ds.is_compulsory DESC, s.name
-        """)
-        print("\nDepartment-Subject Relationships:")
-        for row in cursor.fetchall():
-            print(f"Department: {row['dept_name']}, Subject: {row['subject_name']}, Compulsory: {row['is_compulsory']}")
+def init_db_checksum():
+    """Hash of the code that creates and seeds the schema, and of the migrations.
 
-        # Check Class-Subject requirements
-        cursor.execute("""
-            SELECT c.name as class_name, ca.arm, s.name as subject_name, csr.is_compulsory
-            FROM class_subject_requirements csr
-            JOIN class_arms ca ON csr.class_arm_id = ca.id
-            JOIN classes c ON ca.class_id = c.id
-            JOIN subjects s ON csr.subject_id = s.id
-            ORDER BY c.name, ca.arm, s.name
-        """)
-        print("\nClass-Subject Requirements:")
-        for row in cursor.fetchall():
-            print(f"Class: {row['class_name']} {row['arm']}, Subject: {row['subject_name']}, Compulsory: {row['is_compulsory']}")
+    Returns None when the source cannot be read, so init_db always runs in full.
+    """
+    digest = hashlib.sha256()
+    try:
+        for function in (init_db, initialize_subjects_and_departments, initialize_class_subject_requirements):
+            digest.update(inspect.getsource(function).encode())
+    except (OSError, TypeError):
+        return None
+    digest.update(repr(SCHEMA_MIGRATIONS).encode())
+    return digest.hexdigest()
+
+def database_is_current(db, checksum):
+    """True if init_db last ran with this checksum and every migration is applied. Read-only."""
+    if checksum is None:
+        return False
+    try:
+        seeded = db.execute("SELECT checksum FROM seed_state WHERE name = 'init_db'").fetchone()
+        version = db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    except sqlite3.OperationalError:
+        # A new database, or one from before seed tracking
+        return False
+    finally:
+        # Leave no read transaction open on a connection the app goes on to reuse
+        if db.in_transaction:
+            db.rollback()
+    return seeded is not None and seeded[0] == checksum and version == SCHEMA_MIGRATIONS[-1][0]
+
+# -------------------------
+# Schema migrations
+# -------------------------
+
+# Rankings and their ranking_builds markers are dropped for every scope a
+# changed score or enrolment belongs to
+RANKING_TABLES = ('class_rankings', 'subject_rankings', 'ranking_builds')
+
+def ranking_invalidation_triggers():
+    """DROP and CREATE statements for the triggers that invalidate stored rankings."""
+    statements = []
+    for event, rows in (('INSERT', ('NEW',)),
+                        ('UPDATE OF student_id, subject_id, term, session, report_type, total_score', ('OLD', 'NEW')),
+                        ('DELETE', ('OLD',))):
+        invalidate = "".join(f'''
+                    DELETE FROM {table}
+                    WHERE term = {row}.term AND session = {row}.session AND report_type = {row}.report_type
+                      AND (scope, scope_id) IN (
+                          SELECT 'class', a.class_id FROM student_classes x
+                          JOIN class_arms a ON a.id = x.class_arm_id
+                          WHERE x.student_id = {row}.student_id AND x.session = {row}.session
+                          UNION ALL
+                          SELECT 'arm', x.class_arm_id FROM student_classes x
+                          WHERE x.student_id = {row}.student_id AND x.session = {row}.session
+                      );''' for row in rows for table in RANKING_TABLES)
+        name = f"scores_{event.split()[0].lower()}_rankings"
+        statements += [f"DROP TRIGGER IF EXISTS {name}",
+                       f'''CREATE TRIGGER {name}
+            AFTER {event} ON scores
+            BEGIN{invalidate}
+            END''']
+
+    for event, row in (('INSERT', 'NEW'), ('DELETE', 'OLD')):
+        invalidate = "".join(f'''
+                DELETE FROM {table}
+                WHERE term = {row}.term AND session = {row}.session
+                  AND ((scope = 'class' AND scope_id = (SELECT class_id FROM class_arms WHERE id = {row}.class_arm_id))
+                       OR (scope = 'arm' AND scope_id = {row}.class_arm_id));''' for table in RANKING_TABLES)
+        name = f"student_classes_{event.lower()}_rankings"
+        statements += [f"DROP TRIGGER IF EXISTS {name}",
+                       f'''CREATE TRIGGER {name}
+            AFTER {event} ON student_classes
+            BEGIN{invalidate}
+            END''']
+    return statements
+
+# Migration step adding a column that a CREATE TABLE may already have made
+AddColumn = namedtuple('AddColumn', 'table column definition')
+
+# Shared by init_db and the migration that replaces the pre-scope table
+CLASS_RANKINGS_COLUMNS = """
+    scope TEXT NOT NULL CHECK(scope IN ('class', 'arm')),
+    scope_id INTEGER NOT NULL,
+    term INTEGER NOT NULL,
+    session TEXT NOT NULL,
+    report_type TEXT NOT NULL,
+    student_id INTEGER NOT NULL,
+    average REAL NOT NULL,
+    position INTEGER NOT NULL,
+    dense_position INTEGER NOT NULL,
+    class_average REAL NOT NULL,
+    student_count INTEGER NOT NULL,
+    PRIMARY KEY (scope, scope_id, term, session, report_type, student_id),
+    FOREIGN KEY (student_id) REFERENCES students (id)
+"""
+
+# Applied once each, in version order, and recorded in schema_version.
+# A step is an SQL statement or an AddColumn.
+# Never edit a released step; add a new one.
+SCHEMA_MIGRATIONS = [
+    (1, "Index scores for report, ranking and upload-status lookups", [
+        # Report cards, rankings and missing-score checks look scores up by student
+        """CREATE INDEX IF NOT EXISTS idx_scores_student_term
+           ON scores (student_id, term, session, report_type, subject_id, total_score)""",
+        # Upload previews, upload status and dashboard filters look them up by class arm
+        """CREATE INDEX IF NOT EXISTS idx_scores_class_term
+           ON scores (class_arm_id, term, session, subject_id, report_type, student_id)""",
+    ]),
+    (2, "Index class rosters by class arm and by term", [
+        """CREATE INDEX IF NOT EXISTS idx_student_classes_class_term
+           ON student_classes (class_arm_id, session, term, student_id)""",
+        # Whole-school rankings enumerate every enrolment of a term
+        """CREATE INDEX IF NOT EXISTS idx_student_classes_term
+           ON student_classes (term, session, class_arm_id, student_id)""",
+    ]),
+    (3, "Index per-class report inputs and refresh planner statistics", [
+        """CREATE INDEX IF NOT EXISTS idx_attendance_summary_class_term
+           ON attendance_summary (class_arm_id, term, session)""",
+        """CREATE INDEX IF NOT EXISTS idx_student_assessments_class_term
+           ON student_assessments (class_arm_id, term, session)""",
+        """CREATE INDEX IF NOT EXISTS idx_student_skills_class_term
+           ON student_skills (class_arm_id, term, session)""",
+        "ANALYZE",
+    ]),
+    (4, "Track report input revisions for every enrolment and for moved rows", [
+        # Renders recorded before a student had a revision row were stored as
+        # revision 0; starting backfilled rows at 1 makes those re-check once
+        """INSERT OR IGNORE INTO report_input_revisions (student_id, term, session, revision)
+           SELECT DISTINCT student_id, term, session, 1 FROM student_classes""",
+        # Biodata and photos appear on every report the student has, including
+        # terms with no scores or other inputs yet
+        "DROP TRIGGER IF EXISTS students_update_revision",
+        """CREATE TRIGGER students_update_revision
+           AFTER UPDATE OF full_name, age, gender, photo, department_id ON students
+           BEGIN
+               INSERT INTO report_input_revisions (student_id, term, session)
+               SELECT DISTINCT NEW.id, sc.term, sc.session FROM student_classes sc
+               WHERE sc.student_id = NEW.id AND NOT EXISTS (
+                   SELECT 1 FROM report_input_revisions r
+                   WHERE r.student_id = NEW.id AND r.term = sc.term AND r.session = sc.session
+               );
+               UPDATE report_input_revisions SET revision = revision + 1 WHERE student_id = NEW.id;
+           END""",
+    ] + [
+        # A row moved to another student or term also changes the report it left
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_update_old_revision
+            AFTER UPDATE ON {table}
+            WHEN OLD.student_id IS NOT NEW.student_id OR OLD.term IS NOT NEW.term OR OLD.session IS NOT NEW.session
+            BEGIN
+                INSERT INTO report_input_revisions (student_id, term, session)
+                SELECT OLD.student_id, OLD.term, OLD.session
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM report_input_revisions
+                    WHERE student_id = OLD.student_id AND term = OLD.term AND session = OLD.session
+                );
+                UPDATE report_input_revisions SET revision = revision + 1
+                WHERE student_id = OLD.student_id AND term = OLD.term AND session = OLD.session;
+            END"""
+        for table in ('scores', 'student_assessments', 'attendance_summary', 'student_skills')
+    ]),
+    (5, "Record built ranking scopes so empty ones are not rebuilt on every read", [
+        """CREATE TABLE IF NOT EXISTS ranking_builds (
+               ranking TEXT NOT NULL CHECK(ranking IN ('class', 'subject')),
+               scope TEXT NOT NULL CHECK(scope IN ('class', 'arm')),
+               scope_id INTEGER NOT NULL,
+               term INTEGER NOT NULL,
+               session TEXT NOT NULL,
+               report_type TEXT NOT NULL,
+               built_at TEXT NOT NULL,
+               PRIMARY KEY (ranking, scope, scope_id, term, session, report_type)
+           )""",
+        # Stored scopes have no marker yet, so each is rebuilt once on its next read
+    ] + ranking_invalidation_triggers()),
+    (6, "Track report job heartbeats and attempts for stale job recovery", [
+        "ALTER TABLE report_jobs ADD COLUMN heartbeat_at TEXT",
+        "ALTER TABLE report_jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (7, "Bring report_jobs and class_rankings from earlier builds up to date", [
+        # Booklet output; databases created since then already have these
+        AddColumn('report_jobs', 'output_format', "TEXT NOT NULL DEFAULT 'zip' CHECK(output_format IN ('zip', 'booklet'))"),
+        AddColumn('report_jobs', 'bookmarks', "INTEGER NOT NULL DEFAULT 1"),
+        # Rankings were first keyed by class only; being a cache, the table is
+        # recreated empty and its scopes rebuilt on the next read
+        "DROP TABLE IF EXISTS class_rankings",
+        f"CREATE TABLE class_rankings ({CLASS_RANKINGS_COLUMNS})",
+        "DELETE FROM ranking_builds WHERE ranking = 'class'",
+    ]),
+    (8, "Invalidate rankings when a score moves to another subject",
+     ranking_invalidation_triggers()),
+]
+
+# Representative shapes of the hottest queries, with sample parameters,
+# whose plans migrate_db reports
+HOT_QUERIES = {
+    'class report scores': ("""
+        SELECT sc.student_id, sc.subject_id, sc.total_score FROM scores sc
+        WHERE sc.student_id IN (SELECT student_id FROM student_classes WHERE class_arm_id = ? AND session = ?)
+          AND sc.term = ? AND sc.session = ? AND sc.report_type = ?
+    """, (1, '2025/2026', 1, '2025/2026', 'full_term')),
+    'class ranking': ("""
+        SELECT x.student_id, AVG(sc.total_score) FROM student_classes x
+        JOIN scores sc ON sc.student_id = x.student_id AND sc.term = x.term AND sc.session = x.session
+        WHERE x.term = ? AND x.session = ? AND sc.report_type = ? AND x.class_arm_id = ?
+        GROUP BY x.student_id
+    """, (1, '2025/2026', 'full_term', 1)),
+    'class roster': ("""
+        SELECT s.id, s.full_name FROM students s
+        JOIN student_classes sc ON s.id = sc.student_id
+        WHERE sc.class_arm_id = ? AND sc.session = ? AND sc.term = ?
+    """, (1, '2025/2026', 1)),
+    'upload status': ("""
+        SELECT COUNT(DISTINCT sc.student_id) FROM scores sc
+        JOIN student_classes sclass ON sc.student_id = sclass.student_id
+        WHERE sclass.class_arm_id = ? AND sc.subject_id = ? AND sc.term = ? AND sc.session = ? AND sc.report_type = ?
+    """, (1, 1, 1, '2025/2026', 'full_term')),
+    'upload preview overwrites': ("""
+        SELECT DISTINCT student_id FROM scores
+        WHERE subject_id = ? AND class_arm_id = ? AND term = ? AND session = ?
+    """, (1, 1, 1, '2025/2026')),
+    'dashboard filter': ("""
+        SELECT COUNT(*) FROM scores sc
+        WHERE sc.class_arm_id = ? AND sc.term = ? AND sc.session = ? AND sc.report_type = ?
+    """, (1, 1, '2025/2026', 'full_term')),
+    'report attendance': ("""
+        SELECT student_id, days_present FROM attendance_summary
+        WHERE class_arm_id = ? AND term = ? AND session = ?
+    """, (1, 1, '2025/2026')),
+}
+
+def explain_hot_queries(db):
+    """EXPLAIN QUERY PLAN of every HOT_QUERIES entry, as {name: [plan steps]}."""
+    plans = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        rows = db.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        plans[name] = [row['detail'] for row in rows]
+    return plans
+
+def migrate_db(db, explain=False):
+    """Apply pending SCHEMA_MIGRATIONS in order, each in its own transaction.
+
+    With explain, the hot query plans are printed before and after.
+    Returns the versions applied.
+    """
+    db.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TEXT NOT NULL)""")
+    db.commit()
+    current = db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    pending = [migration for migration in SCHEMA_MIGRATIONS if migration[0] > current]
+    if not pending:
+        return []
+
+    before = explain_hot_queries(db) if explain else None
+    applied = []
+    for version, description, statements in pending:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                if isinstance(statement, AddColumn):
+                    columns = {row[1] for row in db.execute(f"PRAGMA table_info({statement.table})")}
+                    if statement.column in columns:
+                        continue
+                    statement = f"ALTER TABLE {statement.table} ADD COLUMN {statement.column} {statement.definition}"
+                db.execute(statement)
+            db.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                       (version, description, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        print(f"🗂️  Applied migration {version}: {description}")
+        applied.append(version)
+
+    if explain:
+        after = explain_hot_queries(db)
+        for name in HOT_QUERIES:
+            print(f"\n{name}:")
+            for label, plans in (("before", before), ("after", after)):
+                for step in plans[name]:
+                    print(f"   {label:6} {step}")
+    return applied
+
+@app.cli.command("explain-queries")
+def explain_queries_command():
+    """Print the query plans of the hottest queries."""
+    for name, steps in explain_hot_queries(get_db()).items():
+        click.echo(f"\n{name}:")
+        for step in steps:
+            click.echo(f"   {step}")
+
+@app.cli.command("verify-db")
+def verify_db_command():
+    """Check the database and print its schema state and seed data."""
+    db = get_db()
+    cursor = db.cursor()
+
+    click.echo(f"Integrity: {cursor.execute('PRAGMA quick_check').fetchone()[0]}")
+    version = cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    click.echo(f"Schema version: {version} of {SCHEMA_MIGRATIONS[-1][0]}")
+    click.echo(f"Seed data current: {database_is_current(db, init_db_checksum())}\n")
+
+    # Check Classes
+    cursor.execute("SELECT id, name, level FROM classes")
+    click.echo("Classes:")
+    for row in cursor.fetchall():
+        click.echo(f"ID: {row['id']}, Name: {row['name']}, Level: {row['level']}")
+
+    # Check Class Arms
+    cursor.execute("SELECT id, class_id, arm FROM class_arms")
+    click.echo("\nClass Arms:")
+    for row in cursor.fetchall():
+        click.echo(f"Arm ID: {row['id']}, Class ID: {row['class_id']}, Arm: {row['arm']}")
+
+    # Check Departments
+    cursor.execute("SELECT id, name, level FROM departments")
+    click.echo("\nDepartments:")
+    for row in cursor.fetchall():
+        click.echo(f"Dept ID: {row['id']}, Name: {row['name']}, Level: {row['level']}")
+
+    # Check Subjects
+    cursor.execute("SELECT id, name, level, is_common_core FROM subjects ORDER BY level, name")
+    click.echo("\nSubjects:")
+    for row in cursor.fetchall():
+        click.echo(f"Subject ID: {row['id']}, Name: {row['name']}, Level: {row['level']}, Common Core: {row['is_common_core']}")
+
+    # Check Department-Subject relationships
+    cursor.execute("""
+        SELECT d.name as dept_name, s.name as subject_name, ds.is_compulsory
+        FROM department_subjects ds
+        JOIN departments d ON ds.department_id = d.id
+        JOIN subjects s ON ds.subject_id = s.id
+        ORDER BY d.name, ds.is_compulsory DESC, s.name
+    """)
+    click.echo("\nDepartment-Subject Relationships:")
+    for row in cursor.fetchall():
+        click.echo(f"Department: {row['dept_name']}, Subject: {row['subject_name']}, Compulsory: {row['is_compulsory']}")
+
+    # Check Class-Subject requirements
+    cursor.execute("""
+        SELECT c.name as class_name, ca.arm, s.name as subject_name, csr.is_compulsory
+        FROM class_subject_requirements csr
+        JOIN class_arms ca ON csr.class_arm_id = ca.id
+        JOIN classes c ON ca.class_id = c.id
+        JOIN subjects s ON csr.subject_id = s.id
+        ORDER BY c.name, ca.arm, s.name
+    """)
+    click.echo("\nClass-Subject Requirements:")
+    for row in cursor.fetchall():
+        click.echo(f"Class: {row['class_name']} {row['arm']}, Subject: {row['subject_name']}, Compulsory: {row['is_compulsory']}")
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -793,24 +1391,31 @@ def upload_students():
 
     return redirect(url_for('manage_students'))
 
+# Gender spellings accepted in the student register
+STUDENT_GENDERS = {'m': 'Male', 'male': 'Male', 'boy': 'Male',
+                   'f': 'Female', 'female': 'Female', 'girl': 'Female'}
+
+# Senior department named by keywords in the register's department column,
+# tried in order; anything else defaults to Science
+SENIOR_DEPARTMENT_KEYWORDS = [
+    ('Science', ['sci', 'bio', 'chem', 'phy']),
+    ('Arts/Humanities', ['art', 'human', 'lit', 'gov', 'history']),
+    ('Commercial', ['comm', 'bus', 'acct', 'acc', 'eco']),
+]
+
 def process_student_upload(filepath, class_arm_id, session, term):
+    """Register every new student in an uploaded class register at once.
+
+    The register is read a chunk at a time and each chunk is inserted with
+    executemany as it arrives, all in one transaction. Departments are
+    looked up once and classified a column at a time, and reg numbers are
+    allocated as one contiguous block.
+    """
     errors = []
     success_count = 0
     db = get_db()
 
     try:
-        # Load file
-        if filepath.endswith('.csv'):
-            df = pd.read_csv(filepath)
-        else:
-            df = pd.read_excel(filepath)
-
-        df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_')
-
-        # Required columns
-        if 'full_name' not in df.columns:
-            return ["Missing required column: full_name"], 0
-
         cursor = db.cursor()
 
         # Fetch class + arm info
@@ -829,56 +1434,9 @@ def process_student_upload(filepath, class_arm_id, session, term):
         class_level = class_info['level']   # JSS or SSS
         arm = class_info['arm']
 
-        # Get existing students in this class/session/term
-        cursor.execute("""
-            SELECT LOWER(TRIM(s.full_name)) AS lower_name
-            FROM students s
-            JOIN student_classes sc ON s.id = sc.student_id
-            WHERE sc.class_arm_id = ? AND sc.session = ? AND sc.term = ?
-        """, (class_arm_id, session, term))
-
-        existing_students = {row['lower_name'] for row in cursor.fetchall()}
-
-        processed_names = set()
-        new_students = []
-
-        # Process rows
-        for _, row in df.iterrows():
-            full_name = str(row['full_name']).strip()
-            if not full_name:
-                continue
-
-            lname = full_name.lower()
-
-            if lname in processed_names:
-                errors.append(f"Duplicate in file skipped: {full_name}")
-                continue
-            processed_names.add(lname)
-
-            if lname in existing_students:
-                errors.append(f"Already exists skipped: {full_name}")
-                continue
-
-            # Extract optional fields
-            gender = None
-            if 'gender' in df.columns and not pd.isna(row.get('gender', None)):
-                val = str(row['gender']).strip().lower()
-                if val in ['m', 'male', 'boy']: gender = "Male"
-                if val in ['f', 'female', 'girl']: gender = "Female"
-
-            dept_name = None
-            if 'department' in df.columns and not pd.isna(row.get('department', None)):
-                dept_name = str(row['department']).strip()
-
-            new_students.append({
-                'full_name': full_name,
-                'age': int(row['age']) if 'age' in df.columns and not pd.isna(row.get('age', None)) else None,
-                'gender': gender,
-                'department': dept_name
-            })
-
-        if not new_students:
-            return ["No new students to add."], 0
+        # Department ids, read once for every chunk
+        cursor.execute("SELECT id, name FROM departments")
+        department_ids = {row['name']: row['id'] for row in cursor.fetchall()}
 
         # ===== Generate reg-number prefix =====
         # Use the same short-session rule as reg-number function
@@ -889,77 +1447,109 @@ def process_student_upload(filepath, class_arm_id, session, term):
         arm_abbr = arm[0].upper()
         prefix = f"{class_abbr}{arm_abbr}-{session_short}-{term}-"
 
-        # ===== Get highest existing index for this class-arm-session-term =====
-        cursor.execute("""
-            SELECT MAX(CAST(SUBSTR(reg_number, -3) AS INTEGER)) AS max_index
-            FROM students
-            WHERE reg_number LIKE ?
-        """, (prefix + "%",))
-
-        result = cursor.fetchone()
-        start_index = (result['max_index'] + 1) if (result and result['max_index']) else 1
-
-        # ===== Insert new students =====
-        for i, student in enumerate(new_students, start=start_index):
-            full_name = student['full_name']
-            age = student['age']
-            gender = student['gender']
-            dept_name = student['department']
-
-            # Department assignment
-            department_id = None
-
-            if class_level == "JSS":
-                cursor.execute("SELECT id FROM departments WHERE name='Junior'")
-                row = cursor.fetchone()
-                department_id = row['id'] if row else None
-
-            else:  # SSS student
-                if dept_name:
-                    dept_lower = dept_name.lower()
-
-                    if any(k in dept_lower for k in ['sci', 'bio', 'chem', 'phy']):
-                        cursor.execute("SELECT id FROM departments WHERE name='Science'")
-                    elif any(k in dept_lower for k in ['art', 'human', 'lit', 'gov', 'history']):
-                        cursor.execute("SELECT id FROM departments WHERE name='Arts/Humanities'")
-                    elif any(k in dept_lower for k in ['comm', 'bus', 'acct', 'acc', 'eco']):
-                        cursor.execute("SELECT id FROM departments WHERE name='Commercial'")
-                    row = cursor.fetchone()
-                    if row: department_id = row['id']
-
-                # Default senior dept
-                if not department_id:
-                    cursor.execute("SELECT id FROM departments WHERE name='Science'")
-                    row = cursor.fetchone()
-                    department_id = row['id'] if row else None
-
-            # ===== Generate reg number =====
-            reg_number = generate_reg_number(class_name, arm, session, term, i)
-
-            # Insert student
+        # The write lock is held from reading the highest reg number until
+        # the commit, so concurrent registrations cannot allocate the same block
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # ===== Get highest existing index for this class-arm-session-term =====
             cursor.execute("""
-                INSERT INTO students (reg_number, full_name, age, gender, photo, department_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (reg_number, full_name, age, gender, None, department_id))
+                SELECT MAX(CAST(SUBSTR(reg_number, -3) AS INTEGER)) AS max_index
+                FROM students
+                WHERE reg_number LIKE ?
+            """, (prefix + "%",))
 
-            student_id = cursor.lastrowid
+            result = cursor.fetchone()
+            next_index = (result['max_index'] + 1) if (result and result['max_index']) else 1
 
-            # Insert class membership
             cursor.execute("""
-                INSERT OR IGNORE INTO student_classes (student_id, class_arm_id, session, term)
-                VALUES (?, ?, ?, ?)
-            """, (student_id, class_arm_id, session, term))
+                SELECT LOWER(TRIM(s.full_name)) AS lower_name
+                FROM students s
+                JOIN student_classes sc ON s.id = sc.student_id
+                WHERE sc.class_arm_id = ? AND sc.session = ? AND sc.term = ?
+            """, (class_arm_id, session, term))
+            existing_students = {row['lower_name'] for row in cursor.fetchall()}
+            # Names already read from the file, across chunks
+            seen = set()
+
+            for df in iter_upload_frames(filepath):
+                df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_')
+
+                # Required columns
+                if 'full_name' not in df.columns:
+                    db.rollback()
+                    return ["Missing required column: full_name"], 0
+
+                students = df.reindex(columns=['full_name', 'age', 'gender', 'department'])
+
+                # Drop blank names, then flag repeats within the file and students already enrolled
+                students['full_name'] = students['full_name'].astype('string').str.strip()
+                students = students[students['full_name'].notna() & students['full_name'].ne('')]
+                lower_names = students['full_name'].str.lower()
+
+                duplicate = (lower_names.duplicated() | lower_names.isin(seen)).to_numpy()
+                exists = (lower_names.isin(existing_students) & ~duplicate).to_numpy()
+                seen.update(lower_names)
+                for full_name, is_duplicate, is_existing in zip(students['full_name'], duplicate, exists):
+                    if is_duplicate:
+                        errors.append(f"Duplicate in file skipped: {full_name}")
+                    elif is_existing:
+                        errors.append(f"Already exists skipped: {full_name}")
+                students = students[~(duplicate | exists)]
+
+                if students.empty:
+                    continue
 
-            success_count += 1
+                # Optional fields, a column at a time
+                genders = students['gender'].astype('string').str.strip().str.lower().map(STUDENT_GENDERS)
+                ages = pd.to_numeric(students['age'], errors='coerce')
+
+                # Department assignment
+                if class_level == "JSS":
+                    departments = pd.Series('Junior', index=students.index)
+                else:
+                    dept_names = students['department'].astype('string').str.strip().str.lower().fillna('')
+                    departments = pd.Series(np.select(
+                        [dept_names.str.contains('|'.join(keywords), regex=True).to_numpy(dtype=bool)
+                         for _, keywords in SENIOR_DEPARTMENT_KEYWORDS],
+                        [name for name, _ in SENIOR_DEPARTMENT_KEYWORDS],
+                        default='Science'), index=students.index)
+                departments = departments.map(department_ids)
+
+                reg_numbers = [generate_reg_number(class_name, arm, session, term, i)
+                               for i in range(next_index, next_index + len(students))]
+                next_index += len(students)
+
+                # ===== Insert the chunk's students and their class membership =====
+                cursor.executemany("""
+                    INSERT INTO students (reg_number, full_name, age, gender, photo, department_id)
+                    VALUES (?, ?, ?, ?, NULL, ?)
+                """, [(reg_number, full_name,
+                       None if pd.isna(age) else int(age),
+                       None if pd.isna(gender) else gender,
+                       None if pd.isna(department_id) else int(department_id))
+                      for reg_number, full_name, age, gender, department_id
+                      in zip(reg_numbers, students['full_name'], ages, genders, departments)])
+
+                cursor.executemany("""
+                    INSERT OR IGNORE INTO student_classes (student_id, class_arm_id, session, term)
+                    SELECT id, ?, ?, ? FROM students WHERE reg_number = ?
+                """, [(class_arm_id, session, term, reg_number) for reg_number in reg_numbers])
+                success_count += len(reg_numbers)
 
-        db.commit()
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        if not success_count:
+            errors.append("No new students to add.")
 
     except Exception as e:
         errors.append(f"File processing error: {str(e)}")
+        success_count = 0
 
     return errors, success_count
 
-
 @app.route('/upload-student-photo/<reg_number>', methods=['POST'])
 def upload_student_photo(reg_number):
     db = get_db()
@@ -1098,20 +1688,256 @@ def view_students():
                           selected_term=term_filter
                           )
 
+def normalise_name(name):
+    """Case- and whitespace-insensitive form of a student name for matching."""
+    return " ".join(str(name).split()).lower()
+
+def load_class_roster(class_arm_id, session, term):
+    """Students enrolled in a class arm for a term, keyed by normalised full name.
+
+    Names shared by more than one student map to None, as a sheet row
+    cannot say which of them it means.
+    """
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT s.id, s.full_name, s.department_id
+        FROM students s
+        JOIN student_classes sc ON s.id = sc.student_id
+        WHERE sc.class_arm_id = ? AND sc.session = ? AND sc.term = ?
+    """, (class_arm_id, session, term))
+
+    roster = {}
+    for row in cursor.fetchall():
+        key = normalise_name(row['full_name'])
+        if key in roster and roster[key]['id'] != row['id']:
+            roster[key] = None
+        else:
+            roster[key] = row
+    return roster
+
+def resolve_student_ids(names, roster):
+    """Match a Series of sheet names against a class roster in one pass.
+
+    Returns (student_ids, unmatched, ambiguous): student_ids is a Series
+    aligned with `names` holding None where there was no single match, and
+    unmatched / ambiguous list the names as written in the sheet.
+    """
+    keys = names.map(normalise_name)
+    ids = {key: row['id'] for key, row in roster.items() if row is not None}
+    student_ids = pd.Series([ids.get(key) for key in keys], index=names.index, dtype=object)
+
+    ambiguous_mask = keys.isin([key for key, row in roster.items() if row is None])
+    unmatched = names[student_ids.isna() & ~ambiguous_mask].tolist()
+    ambiguous = names[ambiguous_mask].tolist()
+    return student_ids, unmatched, ambiguous
+
+def suggest_student_names(names, name_index):
+    """Label each unmatched sheet name with the closest enrolled name, if any.
+
+    Suggestions are only shown; scores are never saved against a guess.
+    """
+    labelled = []
+    for name in names:
+        student, candidates = name_index.match(name)
+        suggestion = student or (candidates[0] if candidates else None)
+        labelled.append(f"{name} (did you mean {suggestion['full_name']}?)" if suggestion else name)
+    return labelled
+
+def roster_match_errors(unmatched, ambiguous, message="Student not found in this class", name_index=None):
+    """One error line for all unmatched names and one for all ambiguous ones.
+
+    With a StudentNameIndex, unmatched names carry a suggested spelling.
+    """
+    errors = []
+    if unmatched:
+        if name_index is not None:
+            unmatched = suggest_student_names(unmatched, name_index)
+        errors.append(f"{message}: {', '.join(unmatched)}")
+    if ambiguous:
+        errors.append(f"More than one student in this class is named: {', '.join(ambiguous)}")
+    return errors
+
+def iter_upload_frames(source, filename=None, sheet_name=0, chunksize=None):
+    """Yield the rows of an uploaded CSV or .xlsx file as DataFrames.
+
+    `source` is a path, or the file's bytes with `filename` giving its
+    type. Workbooks are streamed through openpyxl's read-only mode and CSVs
+    read in chunks, so memory is bounded by `chunksize` rows
+    (UPLOAD_CHUNK_ROWS by default) rather than by the file. Column names
+    come from the header row, as written. Blank rows at the end of a sheet
+    are dropped, as pd.read_excel drops them. A header with no rows yields
+    one empty frame, so callers still check its columns.
+    """
+    chunksize = chunksize or app.config['UPLOAD_CHUNK_ROWS']
+    name = filename or source
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+
+    if name.lower().endswith('.csv'):
+        yield from pd.read_csv(source, chunksize=chunksize)
+        return
+
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[sheet_name] if isinstance(sheet_name, int) else workbook[sheet_name]
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [f"Unnamed: {i}" if value is None else str(value) for i, value in enumerate(header)]
+        width = len(columns)
+
+        batch = []
+        blank_run = 0
+        yielded = False
+        for row in rows:
+            row = (tuple(row) + (None,) * width)[:width]
+            if all(value is None or value == '' for value in row):
+                blank_run += 1
+                continue
+            # Blank rows only count once a filled row follows them
+            batch.extend([(None,) * width] * blank_run)
+            blank_run = 0
+            batch.append(row)
+            while len(batch) >= chunksize:
+                yield pd.DataFrame(batch[:chunksize], columns=columns)
+                yielded = True
+                batch = batch[chunksize:]
+        if batch or not yielded:
+            # Same as pd.read_csv gives for a header-only CSV
+            yield pd.DataFrame(batch, columns=columns)
+    finally:
+        workbook.close()
+
+# Highest mark allowed in each score column, per report type
+SCORE_LIMITS = {
+    'half_term': {'ca1_score': 5, 'ca2_score': 5},
+    'full_term': {'ca1_score': 5, 'ca2_score': 5, 'ca3_score': 5, 'ca4_score': 5, 'exam_score': 80},
+}
+SCORE_LABELS = {'ca1_score': 'CA1', 'ca2_score': 'CA2', 'ca3_score': 'CA3', 'ca4_score': 'CA4', 'exam_score': 'Exam'}
+
+def validate_score_frame(df, report_type, first_row=2):
+    """Validate an uploaded score sheet a column at a time.
+
+    `df` must already have the normalised column names (full_name,
+    ca1_score, ...); `first_row` is the spreadsheet row of its first row,
+    for frames read a chunk at a time. Half-term blanks count as 0;
+    full-term rows with any blank score are skipped, as the student does
+    not offer the subject.
+    Returns (scores, errors): scores holds the valid rows with numeric
+    score columns, total_score and the spreadsheet row number, and errors
+    lists a message per invalid value, in sheet order.
+    """
+    limits = SCORE_LIMITS[report_type]
+    columns = list(limits)
+
+    names = df['full_name'].astype('string').str.strip()
+    empty_name = (names.isna() | names.eq('') | names.str.lower().eq('nan')).to_numpy(dtype=bool)
+
+    raw = df[columns]
+    blank = raw.isna() | raw.apply(lambda column: column.astype(str).str.strip().eq(''))
+    numeric = raw.apply(pd.to_numeric, errors='coerce')
+    not_numeric = numeric.isna() & ~blank
+    out_of_range = numeric.lt(0) | numeric.gt(pd.Series(limits), axis=1)
+    invalid = (not_numeric | out_of_range).to_numpy()
+
+    if report_type == 'half_term':
+        numeric = numeric.fillna(0)
+        skipped = np.zeros(len(df), dtype=bool)
+        message = "Invalid {label} score for {name}: {value}. Must be between 0-{limit}"
+    else:
+        skipped = blank.any(axis=1).to_numpy()
+        message = "{name}: {label} {value} (must be 0-{limit})"
+
+    rejected = empty_name | (~skipped & invalid.any(axis=1))
+
+    # Only rows with problems are visited to word their messages
+    errors = []
+    for pos in np.flatnonzero(rejected):
+        if empty_name[pos]:
+            errors.append(f"Row {pos + first_row}: Empty or invalid full_name")
+            continue
+        for col_pos in np.flatnonzero(invalid[pos]):
+            column = columns[col_pos]
+            errors.append(message.format(label=SCORE_LABELS[column], name=names.iat[pos],
+                                         value=raw[column].iat[pos], limit=limits[column]))
+
+    keep = ~(rejected | skipped)
+    scores = numeric[keep].astype(float)
+    scores.insert(0, 'full_name', names[keep].astype(object))
+    scores.insert(0, 'row', np.flatnonzero(keep) + first_row)
+    scores['total_score'] = scores[columns].sum(axis=1)
+    return scores.reset_index(drop=True), errors
+
+def upsert_scores(scores, subject_id, class_arm_id, term, session, report_type):
+    """Save one subject upload's scores under a single write lock.
+
+    `scores` is a frame from validate_score_frame with a student_id column.
+    Rows are written with one executemany; existing rows are updated in
+    place (and need approving again) rather than deleted and reinserted.
+    If the batch fails, it is retried row by row, each row in its own
+    savepoint, so only the bad rows are lost.
+    Returns (saved, failures) where failures pairs each rejected row of
+    `scores` with its error message.
+    """
+    columns = list(SCORE_LIMITS[report_type]) + ['total_score']
+    insert_columns = ['student_id', 'subject_id', 'class_arm_id', 'term', 'session',
+                      *columns, 'report_type', 'created_at']
+    sql = f"""
+        INSERT INTO scores ({', '.join(insert_columns)})
+        VALUES ({', '.join('?' * len(insert_columns))})
+        ON CONFLICT(student_id, subject_id, class_arm_id, term, session, report_type) DO UPDATE SET
+            {', '.join(f'{column} = excluded.{column}' for column in columns)},
+            created_at = excluded.created_at,
+            approved = 0
+    """
+
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = list(scores.itertuples(index=False))
+    params = [(row.student_id, subject_id, class_arm_id, term, session,
+               *(getattr(row, column) for column in columns), report_type, now)
+              for row in rows]
+
+    db = get_db()
+    cursor = db.cursor()
+    failures = []
+    # A caller saving several sheets at once owns the transaction and commits it
+    owns_transaction = not db.in_transaction
+    if owns_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("SAVEPOINT upsert_scores")
+        try:
+            cursor.executemany(sql, params)
+            saved = len(params)
+        except sqlite3.Error:
+            cursor.execute("ROLLBACK TO upsert_scores")
+            saved = 0
+            for row, row_params in zip(rows, params):
+                cursor.execute("SAVEPOINT upsert_score_row")
+                try:
+                    cursor.execute(sql, row_params)
+                    saved += 1
+                except sqlite3.Error as e:
+                    cursor.execute("ROLLBACK TO upsert_score_row")
+                    failures.append((row, str(e)))
+                cursor.execute("RELEASE upsert_score_row")
+        cursor.execute("RELEASE upsert_scores")
+        if owns_transaction:
+            db.commit()
+    except Exception:
+        if owns_transaction:
+            db.rollback()
+        raise
+    return saved, failures
+
 def process_half_term_upload(filepath, subject_id, class_arm_id, term, session):
     errors = []
     success_count = 0
     db = get_db()
 
     try:
-        if filepath.endswith('.csv'):
-            df = pd.read_csv(filepath)
-        else:
-            df = pd.read_excel(filepath)
-
-        # df.columns = [col.strip().lower().replace(' ', '_') for col in df.columns]
-        df.columns = df.columns.str.strip().str.lower()
-
         column_mapping = {
             'ca1': 'ca1_score',
             'ca2': 'ca2_score',
@@ -1120,66 +1946,39 @@ def process_half_term_upload(filepath, subject_id, class_arm_id, term, session):
             'exam': 'exam_score',
             'total': 'total_score'
         }
-        df.rename(columns=column_mapping, inplace=True)
-
         required_cols = {'full_name', 'ca1_score', 'ca2_score'}
-        missing_cols = required_cols - set(df.columns)
-        if missing_cols:
-            errors.append(f"Missing required columns: {', '.join(missing_cols)}")
-            return errors, success_count
 
         cursor = db.cursor()
         subject_name = cursor.execute("SELECT name FROM subjects WHERE id = ?", (subject_id,)).fetchone()['name']
-
-        for _, row in df.iterrows():
-            try:
-                full_name = row['full_name'].strip()
-                
-                # Get CA scores
-                ca1_score = float(row['ca1_score']) if not pd.isna(row['ca1_score']) else 0
-                ca2_score = float(row['ca2_score']) if not pd.isna(row['ca2_score']) else 0
-                
-                # Validate scores
-                if not (0 <= ca1_score <= 5):
-                    errors.append(f"Invalid CA1 score for {full_name}: {ca1_score}. Must be between 0-5")
-                    continue
-                if not (0 <= ca2_score <= 5):
-                    errors.append(f"Invalid CA2 score for {full_name}: {ca2_score}. Must be between 0-5")
-                    continue
-
-                # Calculate total score for half-term
-                total_score = ca1_score + ca2_score
-
-                # Find student
-                cursor.execute("""
-                    SELECT s.id, s.department_id
-                    FROM students s
-                    JOIN student_classes sc ON s.id = sc.student_id
-                    WHERE sc.class_arm_id = ? AND sc.session = ? AND sc.term = ? AND s.full_name = ?
-                """, (class_arm_id, session, term, full_name))
-
-                student_row = cursor.fetchone()
-                if not student_row:
-                    errors.append(f"Student not found in this class: {full_name}")
-                    continue
-
-                student_id = student_row['id']
-                now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                # Insert or update half-term scores
-                cursor.execute('''INSERT OR REPLACE INTO scores 
-                                  (student_id, subject_id, class_arm_id, term, session,
-                                   ca1_score, ca2_score, total_score, report_type, created_at) 
-                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                               (student_id, subject_id, class_arm_id, term, session,
-                                ca1_score, ca2_score, total_score, 'half_term', now))
-
-                success_count += 1
-                
-            except Exception as e:
-                errors.append(f"Error processing {full_name}: {str(e)}")
-
-        db.commit()
+        roster = load_class_roster(class_arm_id, session, term)
+        name_index = get_student_name_index(class_arm_id, session)
+
+        # Stream the sheet, validating and saving a chunk of rows at a time
+        first_row = 2
+        for df in iter_upload_frames(filepath):
+            df.columns = df.columns.str.strip().str.lower()
+            df.rename(columns=column_mapping, inplace=True)
+
+            missing_cols = required_cols - set(df.columns)
+            if missing_cols:
+                errors.append(f"Missing required columns: {', '.join(missing_cols)}")
+                return errors, success_count
+
+            # Validate and total the chunk at once
+            scores, chunk_errors = validate_score_frame(df, 'half_term', first_row)
+            errors.extend(chunk_errors)
+            first_row += len(df)
+
+            # Match every name against the class roster
+            scores['student_id'], unmatched, ambiguous = resolve_student_ids(scores['full_name'], roster)
+            errors.extend(roster_match_errors(unmatched, ambiguous, name_index=name_index))
+            scores = scores[scores['student_id'].notna()]
+
+            # Insert or update the chunk's half-term scores in one transaction
+            saved, failures = upsert_scores(scores, subject_id, class_arm_id, term, session, 'half_term')
+            success_count += saved
+            for row, error in failures:
+                errors.append(f"Error processing {row.full_name}: {error}")
 
     except Exception as e:
         errors.append(f"File processing error: {str(e)}")
@@ -1192,140 +1991,276 @@ def process_full_term_upload(filepath, subject_id, class_arm_id, term, session):
     db = get_db()
 
     try:
+        cursor = db.cursor()
+
         # ------------------------------------------------------------------
-        # 1. Read the file
+        # 1. Verify that the subject actually exists
         # ------------------------------------------------------------------
-        if filepath.lower().endswith('.csv'):
-            df = pd.read_csv(filepath)
-        else:
-            df = pd.read_excel(filepath, engine='openpyxl')   # explicit engine helps
-
-        # Normalise column names
-        df.columns = df.columns.str.strip().str.lower()
+        cursor.execute("SELECT name FROM subjects WHERE id = ?", (subject_id,))
+        subject_row = cursor.fetchone()
+        if not subject_row:
+            errors.append(f"Subject with id={subject_id} not found in the database.")
+            return errors, success_count
+        subject_name = subject_row['name']       # now safe
 
         # ------------------------------------------------------------------
-        # 2. Rename columns to what the code expects
+        # 2. Load every student in the class/term/session with one roster query
         # ------------------------------------------------------------------
+        roster = load_class_roster(class_arm_id, session, term)
+        name_index = get_student_name_index(class_arm_id, session)
+
         column_mapping = {
             'ca1': 'ca1_score', 'ca2': 'ca2_score',
             'ca3': 'ca3_score', 'ca4': 'ca4_score',
             'exam': 'exam_score', 'total': 'total_score'
         }
-        df.rename(columns=column_mapping, inplace=True)
-
         required_cols = {'full_name', 'ca1_score', 'ca2_score',
                          'ca3_score', 'ca4_score', 'exam_score'}
-        missing_cols = required_cols - set(df.columns)
-        if missing_cols:
-            errors.append(f"Missing required columns: {', '.join(missing_cols)}")
-            return errors, success_count
-
-        cursor = db.cursor()
-
-        # ------------------------------------------------------------------
-        # 3. Verify that the subject actually exists
-        # ------------------------------------------------------------------
-        cursor.execute("SELECT name FROM subjects WHERE id = ?", (subject_id,))
-        subject_row = cursor.fetchone()
-        if not subject_row:
-            errors.append(f"Subject with id={subject_id} not found in the database.")
-            return errors, success_count
-        subject_name = subject_row['name']       # now safe
 
-        
         # ------------------------------------------------------------------
-        # 4. Process each row
+        # 3. Stream the file a chunk of rows at a time
         # ------------------------------------------------------------------
-        for idx, row in df.iterrows():
-            try:
-                full_name = str(row['full_name']).strip()
-                if not full_name or full_name.lower() == 'nan':
-                    errors.append(f"Row {idx+2}: Empty or invalid full_name")
-                    continue
+        first_row = 2
+        for df in iter_upload_frames(filepath):
+            # Normalise column names and rename them to what the code expects
+            df.columns = df.columns.str.strip().str.lower()
+            df.rename(columns=column_mapping, inplace=True)
+
+            missing_cols = required_cols - set(df.columns)
+            if missing_cols:
+                errors.append(f"Missing required columns: {', '.join(missing_cols)}")
+                return errors, success_count
+
+            # --------------------------------------------------------------
+            # 4. Validate the chunk column by column; rows with blank
+            #    scores (subject not offered) are skipped
+            # --------------------------------------------------------------
+            scores, chunk_errors = validate_score_frame(df, 'full_term', first_row)
+            errors.extend(chunk_errors)
+            first_row += len(df)
+
+            # --------------------------------------------------------------
+            # 5. Match the chunk's names against the roster
+            # --------------------------------------------------------------
+            scores['student_id'], unmatched, ambiguous = resolve_student_ids(scores['full_name'], roster)
+            errors.extend(roster_match_errors(unmatched, ambiguous,
+                                              "Student not enrolled in this class/term/session",
+                                              name_index))
+            scores = scores[scores['student_id'].notna()]
+
+            # --------------------------------------------------------------
+            # 6. Insert / update the chunk's valid rows in one transaction
+            # --------------------------------------------------------------
+            saved, failures = upsert_scores(scores, subject_id, class_arm_id, term, session, 'full_term')
+            success_count += saved
+            for row, error in failures:
+                errors.append(f"Row {row.row} ({row.full_name}): {error}")
 
-                def read_score(val):
-                    """
-                    Returns:
-                    - float score if valid
-                    - None if blank / NaN / invalid
-                    """
-                    try:
-                        if pd.isna(val):
-                            return None
-                        return float(val)
-                    except:
-                        return None
-
-
-                ca1_score = read_score(row['ca1_score'])
-                ca2_score = read_score(row['ca2_score'])
-                ca3_score = read_score(row['ca3_score'])
-                ca4_score = read_score(row['ca4_score'])
-                exam_score = read_score(row['exam_score'])
-
-                # ---- find the student in the correct class/term/session ----------
-                cursor.execute("""
-                    SELECT s.id, s.department_id
-                    FROM students s
-                    JOIN student_classes sc ON s.id = sc.student_id
-                    WHERE sc.class_arm_id = ? 
-                      AND sc.session = ? 
-                      AND sc.term = ? 
-                      AND LOWER(TRIM(s.full_name)) = LOWER(TRIM(?))
-                """, (class_arm_id, session, term, full_name))
-
-                student_row = cursor.fetchone()
-                if not student_row:
-                    errors.append(f"Student not enrolled in this class/term/session: {full_name}")
-                    continue
-
-                student_id = student_row['id']
+    except Exception as e:
+        errors.append(f"File processing error: {str(e)}")
+    return errors, success_count
 
-                # ---- insert / replace the score ----------------------------------
+# -------------------------
+# Multi-subject uploads
+# -------------------------
 
-                now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                if ca1_score and ca2_score and ca3_score and ca4_score and exam_score:
+SCORE_COLUMN_MAPPING = {
+    'ca1': 'ca1_score', 'ca2': 'ca2_score',
+    'ca3': 'ca3_score', 'ca4': 'ca4_score',
+    'exam': 'exam_score', 'total': 'total_score'
+}
 
-                    # ---- validation --------------------------------------------------
-                    if not (0 <= ca1_score <= 5):
-                        errors.append(f"{full_name}: CA1 {ca1_score} (must be 0-5)")
-                        continue
-                    if not (0 <= ca2_score <= 5):
-                        errors.append(f"{full_name}: CA2 {ca2_score} (must be 0-5)")
-                        continue
-                    if not (0 <= ca3_score <= 5):
-                        errors.append(f"{full_name}: CA3 {ca3_score} (must be 0-5)")
-                        continue
-                    if not (0 <= ca4_score <= 5):
-                        errors.append(f"{full_name}: CA4 {ca4_score} (must be 0-5)")
-                        continue
-                    if not (0 <= exam_score <= 80):
-                        errors.append(f"{full_name}: Exam {exam_score} (must be 0-80)")
-                        continue
-                    
-                    total_score = ca1_score + ca2_score + ca3_score + ca4_score + exam_score
+# generate_test_results names its files "<Subject_Name>_full_term_test_results.xlsx"
+RESULT_FILE_SUFFIX = re.compile(r'_(full|half)_term(_test)?_results$', re.IGNORECASE)
 
-                    cursor.execute("""
-                        INSERT OR REPLACE INTO scores 
-                        (student_id, subject_id, class_arm_id, term, session,
-                        ca1_score, ca2_score, ca3_score, ca4_score,
-                        exam_score, total_score, report_type, created_at)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (student_id, subject_id, class_arm_id, term, session,
-                        ca1_score, ca2_score, ca3_score, ca4_score,
-                        exam_score, total_score, 'full_term', now))
+def subject_sheet_key(name):
+    """Form of a subject or sheet name used to pair them up.
 
-                    success_count += 1
+    Excel caps sheet names at 31 characters, so longer subject names are
+    compared on their first 31.
+    """
+    return normalise_name(str(name).replace('_', ' '))[:31]
 
-            except Exception as row_err:
-                errors.append(f"Row {idx+2} ({full_name}): {str(row_err)}")
+def result_file_subject(filename):
+    """Subject name part of a result file name in a ZIP bundle."""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return RESULT_FILE_SUFFIX.sub('', stem)
 
-        db.commit()
+def parse_score_sheet(source, report_type, sheet_name=0, filename=None, chunksize=None):
+    """Read and validate one subject's score sheet.
 
+    `source` is a path, or the file's bytes with `filename` giving its
+    type. Runs in the upload process pool, so it touches neither the
+    database nor the Flask app; callers there pass `chunksize` in rather
+    than leaving it to app.config. Returns (scores, errors) as
+    validate_score_frame does; scores is None if the sheet cannot be used.
+    """
+    try:
+        chunks = []
+        errors = []
+        first_row = 2
+        for df in iter_upload_frames(source, filename, sheet_name, chunksize):
+            df.columns = df.columns.astype(str).str.strip().str.lower()
+            df = df.rename(columns=SCORE_COLUMN_MAPPING)
+
+            missing_cols = {'full_name', *SCORE_LIMITS[report_type]} - set(df.columns)
+            if missing_cols:
+                return None, [f"Missing required columns: {', '.join(sorted(missing_cols))}"]
+
+            scores, chunk_errors = validate_score_frame(df, report_type, first_row)
+            chunks.append(scores)
+            errors.extend(chunk_errors)
+            first_row += len(df)
+
+        if first_row == 2:
+            return None, ["The sheet has no rows"]
+        return pd.concat(chunks, ignore_index=True), errors
     except Exception as e:
-        errors.append(f"File processing error: {str(e)}")
+        return None, [f"File processing error: {str(e)}"]
+
+_upload_process_pool = None
+_upload_process_pool_pid = None
+_upload_process_pool_lock = threading.Lock()
+
+def get_upload_process_pool():
+    """Return this worker process's pool of sheet parsers."""
+    global _upload_process_pool, _upload_process_pool_pid
+    with _upload_process_pool_lock:
+        if _upload_process_pool is None or _upload_process_pool_pid != os.getpid():
+            _upload_process_pool = ProcessPoolExecutor(max_workers=app.config['UPLOAD_PARSE_WORKERS'])
+            _upload_process_pool_pid = os.getpid()
+        return _upload_process_pool
+
+@atexit.register
+def close_upload_process_pool():
+    global _upload_process_pool
+    if _upload_process_pool is not None and _upload_process_pool_pid == os.getpid():
+        _upload_process_pool.shutdown(cancel_futures=True)
+    _upload_process_pool = None
+
+def process_score_sheets(sheets, class_arm_id, term, session, report_type, whole_sheets=False):
+    """Save several subjects' score sheets for a class arm in one transaction.
+
+    `sheets` lists (name, subject_name, source, options): subject_name is
+    matched against the subjects the class arm takes, and source and
+    options are handed to parse_score_sheet. Sheets are parsed and
+    validated in parallel, names are resolved against one roster query,
+    and all scores are written before a single commit. With whole_sheets,
+    a sheet with any error is rolled back as a unit instead of keeping
+    its good rows.
+    Returns a report dict per sheet, in the given order, with the
+    subject, saved count and errors.
+    """
+    db = get_db()
+    cursor = db.cursor()
+    # Subject names repeat across levels, so only the class's own subjects are candidates
+    cursor.execute("""
+        SELECT s.id, s.name
+        FROM subjects s
+        JOIN class_subject_requirements csr ON csr.subject_id = s.id
+        WHERE csr.class_arm_id = ?
+    """, (class_arm_id,))
+    subjects = {}
+    for subject in cursor.fetchall():
+        key = subject_sheet_key(subject['name'])
+        subjects[key] = None if key in subjects else subject
+
+    reports = []
+    futures = []
+    pool = get_upload_process_pool()
+    # Workers get the setting passed in; they do not read app.config
+    chunksize = app.config['UPLOAD_CHUNK_ROWS']
+    for name, subject_name, source, options in sheets:
+        subject = subjects.get(subject_sheet_key(subject_name))
+        report = {'sheet': name, 'subject': subject['name'] if subject else None,
+                  'saved': 0, 'errors': []}
+        reports.append(report)
+        if subject is None:
+            report['errors'].append(f"'{subject_name}' does not match exactly one subject of this class; skipped")
+            continue
+        futures.append((report, subject, pool.submit(parse_score_sheet, source, report_type,
+                                                     chunksize=chunksize, **options)))
+
+    roster = load_class_roster(class_arm_id, session, term)
+    name_index = get_student_name_index(class_arm_id, session)
+    pending = []
+    for report, subject, future in futures:
+        scores, errors = future.result()
+        report['errors'].extend(errors)
+        if scores is None:
+            continue
 
-    return errors, success_count
+        scores['student_id'], unmatched, ambiguous = resolve_student_ids(scores['full_name'], roster)
+        report['errors'].extend(roster_match_errors(unmatched, ambiguous,
+                                                    "Student not enrolled in this class/term/session",
+                                                    name_index))
+        if whole_sheets and report['errors']:
+            continue
+        pending.append((report, subject, scores[scores['student_id'].notna()]))
+
+    # The write lock is only taken once every sheet has been parsed
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        for report, subject, scores in pending:
+            cursor.execute("SAVEPOINT score_sheet")
+            saved, failures = upsert_scores(scores, subject['id'], class_arm_id,
+                                            term, session, report_type)
+            for row, error in failures:
+                report['errors'].append(f"Row {row.row} ({row.full_name}): {error}")
+            if whole_sheets and failures:
+                cursor.execute("ROLLBACK TO score_sheet")
+            else:
+                report['saved'] = saved
+            cursor.execute("RELEASE score_sheet")
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    if whole_sheets:
+        for report in reports:
+            if report['errors'] and report['subject']:
+                report['errors'].append("Nothing from this file was saved")
+    return reports
+
+def process_results_workbook(filepath, class_arm_id, term, session, report_type):
+    """Save every sheet of a results workbook, each named after its subject."""
+    with pd.ExcelFile(filepath, engine='openpyxl') as workbook:
+        sheet_names = workbook.sheet_names
+    sheets = [(sheet_name, sheet_name, filepath, {'sheet_name': sheet_name})
+              for sheet_name in sheet_names]
+    return process_score_sheets(sheets, class_arm_id, term, session, report_type)
+
+def process_results_bundle(filepath, class_arm_id, term, session, report_type):
+    """Save every result file in a ZIP bundle, each named after its subject.
+
+    Entries are read from the archive in memory, never extracted, and a
+    file with any error is rejected as a whole. A bundle over the
+    UPLOAD_BUNDLE_* limits is refused before anything is read.
+    """
+    with zipfile.ZipFile(filepath) as bundle:
+        entries = [entry for entry in bundle.infolist()
+                   if not (entry.is_dir() or entry.filename.startswith('__MACOSX/')
+                           or os.path.basename(entry.filename).startswith('.')
+                           or not allowed_file(entry.filename))]
+
+        if len(entries) > app.config['UPLOAD_BUNDLE_MAX_FILES']:
+            raise ValueError(f"the bundle holds {len(entries)} result files; "
+                             f"at most {app.config['UPLOAD_BUNDLE_MAX_FILES']} are allowed")
+        max_file_mb = app.config['UPLOAD_BUNDLE_MAX_FILE_BYTES'] / (1024 * 1024)
+        for entry in entries:
+            # file_size is what the entry unpacks to; reads stop there even if it lies
+            if entry.file_size > app.config['UPLOAD_BUNDLE_MAX_FILE_BYTES']:
+                raise ValueError(f"{entry.filename} is larger than {max_file_mb:g} MB")
+        if sum(entry.file_size for entry in entries) > app.config['UPLOAD_BUNDLE_MAX_BYTES']:
+            raise ValueError(f"the bundle unpacks to more than "
+                             f"{app.config['UPLOAD_BUNDLE_MAX_BYTES'] / (1024 * 1024):g} MB")
+
+        sheets = [(entry.filename, result_file_subject(entry.filename), bundle.read(entry),
+                   {'filename': entry.filename})
+                  for entry in entries]
+    return process_score_sheets(sheets, class_arm_id, term, session, report_type,
+                                whole_sheets=True)
 
 @app.route('/upload-half-term-results')
 def upload_half_term_results():
@@ -1402,19 +2337,113 @@ def upload_full_term_results():
 
     return redirect(url_for('upload_full_term_results'))
 
+class UploadPreviewStore:
+    """Parsed score uploads waiting to be confirmed, addressed by a random token.
+
+    Entries are pickled to folder/<token>.pkl and expire ttl seconds after
+    they were written; expired entries are swept on every write. Only the
+    server writes these files, and tokens are checked before they are used
+    as file names.
+    """
+
+    TOKEN = re.compile(r'[A-Za-z0-9_-]{22}')
+
+    def __init__(self, folder, ttl):
+        self.folder = folder
+        self.ttl = ttl
+
+    def path(self, token):
+        return os.path.join(self.folder, f"{token}.pkl")
+
+    def put(self, entry):
+        os.makedirs(self.folder, exist_ok=True)
+        self._sweep()
+        token = secrets.token_urlsafe(16)
+        path = self.path(token)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        return token
+
+    def take(self, token):
+        """Remove and return an entry; None if it is unknown, expired or already taken."""
+        if not token or not self.TOKEN.fullmatch(token):
+            return None
+        path = self.path(token)
+        claimed = f"{path}.{os.getpid()}.{threading.get_ident()}.taken"
+        try:
+            # Renaming first means a double-submitted confirm saves only once
+            os.rename(path, claimed)
+        except OSError:
+            return None
+        try:
+            if os.path.getmtime(claimed) + self.ttl < time.time():
+                return None
+            with open(claimed, 'rb') as f:
+                return pickle.load(f)
+        finally:
+            os.remove(claimed)
+
+    def _sweep(self):
+        cutoff = time.time() - self.ttl
+        for entry in os.scandir(self.folder):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+upload_previews = UploadPreviewStore(app.config['UPLOAD_PREVIEW_FOLDER'], app.config['UPLOAD_PREVIEW_TTL_SECONDS'])
+
+def parse_score_upload(filepath, report_type, roster):
+    """Read, validate and resolve a whole score sheet for the preview page.
+
+    Returns (rows, scores, errors, unmatched, ambiguous): the sheet as
+    uploaded, its valid rows with student_id resolved against `roster`
+    (unmatched rows dropped), and the problems found. scores is None if
+    required columns are missing.
+    """
+    rows, frames, errors = [], [], []
+    unmatched, ambiguous = [], []
+    first_row = 2
+    for df in iter_upload_frames(filepath):
+        df.columns = df.columns.astype(str).str.strip().str.lower()
+        rows.append(df)
+        df = df.rename(columns=SCORE_COLUMN_MAPPING)
+
+        missing_cols = {'full_name', *SCORE_LIMITS[report_type]} - set(df.columns)
+        if missing_cols:
+            return None, None, [f"Missing required columns: {', '.join(sorted(missing_cols))}"], [], []
+
+        scores, chunk_errors = validate_score_frame(df, report_type, first_row)
+        errors.extend(chunk_errors)
+        first_row += len(df)
+
+        scores['student_id'], chunk_unmatched, chunk_ambiguous = resolve_student_ids(scores['full_name'], roster)
+        unmatched.extend(chunk_unmatched)
+        ambiguous.extend(chunk_ambiguous)
+        frames.append(scores[scores['student_id'].notna()])
+
+    if first_row == 2:
+        return None, None, ["The file has no rows"], [], []
+    return pd.concat(rows, ignore_index=True), pd.concat(frames, ignore_index=True), errors, unmatched, ambiguous
+
 @app.route('/preview-results', methods=['POST'])
 def preview_results():
     """Show preview of uploaded result file before confirming."""
     try:
         report_type = request.form.get("report_type")  # 'half_term' or 'full_term'
-        subject_id = request.form.get("subject_id")
-        class_arm_id = request.form.get("class_arm_id")
+        subject_id = request.form.get("subject_id", type=int)
+        class_arm_id = request.form.get("class_arm_id", type=int)
         term = int(request.form.get("term"))
         session = request.form.get("session")
 
         # Validate form inputs
         if not all([report_type, subject_id, class_arm_id, term, session]):
             return render_template("error.html", message="Missing required fields.")
+        if report_type not in SCORE_LIMITS:
+            return render_template("error.html", message="Invalid report type.")
 
         # Validate file
         if 'file' not in request.files:
@@ -1424,33 +2453,21 @@ def preview_results():
         if file.filename == '':
             return render_template("error.html", message="Empty file name.")
 
-        # Save file temporarily
+        # Parse, validate and resolve the file once; confirming saves from the parsed copy
         temp_filename = f"temp_{datetime.now().timestamp()}_{secure_filename(file.filename)}"
         temp_path = os.path.join(app.config['UPLOAD_FOLDER'], temp_filename)
         file.save(temp_path)
+        try:
+            rows, scores, errors, unmatched_names, ambiguous_names = parse_score_upload(
+                temp_path, report_type, load_class_roster(class_arm_id, session, term))
+        finally:
+            os.remove(temp_path)
 
-        # Load DataFrame
-        df = pd.read_excel(temp_path) if temp_path.endswith(".xlsx") else pd.read_csv(temp_path)
-        df.columns = df.columns.str.strip().str.lower()
-
-        # Column requirements
-        required_cols = {'full_name', 'ca1', 'ca2'} if report_type == "half_term" else {
-            'full_name', 'ca1', 'ca2', 'ca3', 'ca4', 'exam'
-        }
-
-        # Detect missing columns
-        missing = required_cols - set(df.columns)
-        if missing:
-            return render_template(
-                "upload_error.html",
-                errors=[f"Missing required columns: {', '.join(missing)}"],
-                success_count=0
-            )
+        if scores is None:
+            return render_template("upload_error.html", errors=errors, success_count=0)
 
-        # Check existing scores that might be overwritten
         db = get_db()
         cursor = db.cursor()
-        overwrite_warnings = []
 
         cursor.execute("""
             SELECT sub.name
@@ -1468,43 +2485,40 @@ def preview_results():
         """, (class_arm_id,))
         class_data = cursor.fetchone()
 
-        for name in df['full_name']:
-
-            # 1. Lookup student ID from name
-            cursor.execute("""
-                SELECT s.id
-                FROM students s
-                JOIN student_classes sc ON s.id = sc.student_id
-                WHERE sc.class_arm_id=? AND sc.session=? AND sc.term=? AND s.full_name=?
-            """, (class_arm_id, session, term, name.strip()))
-
-            student = cursor.fetchone()
-            if not student:
-                continue  # or collect as an error
-            
-            student_id = student['id']
-
-            # 2. Check if scores already exist for this student
-            cursor.execute("""
-                SELECT 1 FROM scores
-                WHERE student_id=? AND subject_id=? AND class_arm_id=? AND term=? AND session=?
-            """, (student_id, subject_id, class_arm_id, term, session))
-
-            if cursor.fetchone():
-                overwrite_warnings.append(name.strip())
+        # Students who already have scores for this subject
+        cursor.execute("""
+            SELECT DISTINCT student_id FROM scores
+            WHERE subject_id=? AND class_arm_id=? AND term=? AND session=?
+        """, (subject_id, class_arm_id, term, session))
+        existing = {row['student_id'] for row in cursor.fetchall()}
+        overwrite_warnings = scores.loc[scores['student_id'].isin(existing), 'full_name'].tolist()
+
+        # Unmatched names are shown with the closest enrolled spelling
+        name_index = get_student_name_index(class_arm_id, session)
+        unmatched_message = ("Student not enrolled in this class/term/session"
+                             if report_type == "full_term" else "Student not found in this class")
+        preview_token = upload_previews.put({
+            'report_type': report_type,
+            'subject_id': subject_id,
+            'class_arm_id': class_arm_id,
+            'term': term,
+            'session': session,
+            'scores': scores,
+            'errors': errors + roster_match_errors(unmatched_names, ambiguous_names, unmatched_message, name_index),
+        })
 
         return render_template(
             "results_preview.html",
-            df=df.to_dict(orient='records'),
+            df=rows.to_dict(orient='records'),
             report_type=report_type,
             subject=subject,
             class_data=class_data,
-            subject_id=subject_id,    
-            class_arm_id=class_arm_id,
             term=term,
             session=session,
-            temp_path=temp_path,
-            overwrite_warnings=overwrite_warnings
+            preview_token=preview_token,
+            overwrite_warnings=overwrite_warnings,
+            unmatched_names=suggest_student_names(unmatched_names, name_index) + ambiguous_names,
+            row_errors=errors
         )
 
     except Exception as e:
@@ -1512,28 +2526,14 @@ def preview_results():
 
 @app.route('/confirm-results-upload', methods=['POST'])
 def confirm_results_upload():
-    """Final commit of results (after preview)."""
-    report_type = request.form.get("report_type")
-    subject_id = request.form.get("subject_id")
-    class_arm_id = request.form.get("class_arm_id")
-    term = request.form.get("term")
-    session = request.form.get("session")
-    temp_path = request.form.get("temp_path")
-
-    if not os.path.exists(temp_path):
-        return render_template("error.html", message="Temporary file missing. Please re-upload.")
+    """Final commit of results (after preview), from the copy parsed for the preview."""
+    upload = upload_previews.take(request.form.get("preview_token"))
+    if upload is None:
+        return render_template("error.html", message="This preview has expired or was already confirmed. Please re-upload.")
 
-    if report_type not in ("half_term", "full_term"):
-        return render_template("error.html", message="Invalid report type.")
-
-    # Call correct processing function
-    if report_type == "half_term":
-        errors, success_count = process_half_term_upload(temp_path, subject_id, class_arm_id, term, session)
-    else:
-        errors, success_count = process_full_term_upload(temp_path, subject_id, class_arm_id, term, session)
-
-    # Cleanup
-    os.remove(temp_path)
+    success_count, failures = upsert_scores(upload['scores'], upload['subject_id'], upload['class_arm_id'],
+                                            upload['term'], upload['session'], upload['report_type'])
+    errors = upload['errors'] + [f"Row {row.row} ({row.full_name}): {error}" for row, error in failures]
 
     if errors:
         return render_template("upload_error.html", errors=errors, success_count=success_count)
@@ -1542,6 +2542,47 @@ def confirm_results_upload():
                            message=f"{success_count} records uploaded!",
                            success_count=success_count)
 
+def save_multi_subject_upload(extension, processor, prefix, source_label):
+    """Shared handling for the workbook and ZIP bundle upload forms."""
+    report_type = request.form.get("report_type")
+    class_arm_id = request.form.get("class_arm_id", type=int)
+    term = request.form.get("term", type=int)
+    session = request.form.get("session")
+
+    if not all([report_type, class_arm_id, term, session]):
+        return render_template("error.html", message="Missing required fields.")
+    if report_type not in SCORE_LIMITS:
+        return render_template("error.html", message="Invalid report type.")
+
+    file = request.files.get('file')
+    if not file or not file.filename.lower().endswith(extension):
+        return render_template("error.html", message=f"Please upload a {extension} file.")
+
+    filename = f"{prefix}_{datetime.now().timestamp()}_{secure_filename(file.filename)}"
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    file.save(filepath)
+    try:
+        sheets = processor(filepath, class_arm_id, term, session, report_type)
+    except Exception as e:
+        return render_template("error.html", message=f"File processing error: {str(e)}")
+    finally:
+        os.remove(filepath)
+
+    return render_template("workbook_upload_report.html",
+                           sheets=sheets,
+                           source_label=source_label,
+                           success_count=sum(sheet['saved'] for sheet in sheets))
+
+@app.route('/upload-results-workbook', methods=['POST'])
+def upload_results_workbook():
+    """Upload one workbook holding a sheet of scores per subject."""
+    return save_multi_subject_upload('.xlsx', process_results_workbook, 'workbook', 'Sheet')
+
+@app.route('/upload-results-bundle', methods=['POST'])
+def upload_results_bundle():
+    """Upload a ZIP of result files, one per subject, for a class arm."""
+    return save_multi_subject_upload('.zip', process_results_bundle, 'bundle', 'File')
+
 @app.route('/results')
 def view_results():
     db = get_db()
@@ -1561,12 +2602,107 @@ def view_results():
     results = cursor.fetchall()
     return render_template('results.html', results=results)
 
-def get_best_student_match(class_arm_id, session, full_name):
-    """Simple approach that always returns one student or None"""
-    search_name = full_name.strip()
-    
+def name_trigrams(name):
+    """Character trigrams of a normalised name, padded so word starts count."""
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class StudentNameIndex:
+    """Name lookup over the students of one class arm and session.
+
+    Holds each student's normalised name, an inverted map from name
+    tokens to students, and one from character trigrams to students, so a
+    lookup only scores the students that share a word or trigram with the
+    search rather than scanning the roster.
+    """
+
+    # Trigram similarity a misspelt name needs, and its lead over the runner-up
+    FUZZY_THRESHOLD = 0.6
+    FUZZY_MARGIN = 0.1
+
+    def __init__(self, students):
+        self.students = [dict(student) for student in students]
+        self.names = [normalise_name(student['full_name']) for student in self.students]
+        self.name_tokens = [set(name.split()) for name in self.names]
+        self.name_grams = [name_trigrams(name) for name in self.names]
+
+        self.by_name = defaultdict(list)
+        self.by_token = defaultdict(set)
+        self.by_trigram = defaultdict(set)
+        for i, name in enumerate(self.names):
+            self.by_name[name].append(i)
+            for token in self.name_tokens[i]:
+                self.by_token[token].add(i)
+            for gram in self.name_grams[i]:
+                self.by_trigram[gram].add(i)
+
+    def match(self, full_name):
+        """Find the one student a typed name means.
+
+        Tries, in order: the exact name, the only name containing the search,
+        the only name contained in it, the only name sharing a word, and
+        finally the clearly closest name by trigram similarity.
+        Returns (student, candidates): student is None when there is no
+        single match, and candidates then lists the closest students.
+        """
+        search = normalise_name(full_name)
+        if not search:
+            return None, []
+
+        exact = self.by_name.get(search, [])
+        if len(exact) == 1:
+            return self.students[exact[0]], []
+        if exact:
+            return None, [self.students[i] for i in exact]
+
+        words = set(search.split())
+        grams = name_trigrams(search)
+        shared_grams = defaultdict(int)
+        for gram in grams:
+            for i in self.by_trigram.get(gram, ()):
+                shared_grams[i] += 1
+        pool = set(shared_grams).union(*(self.by_token.get(word, ()) for word in words))
+        if len(search) < 3:
+            # Too short to share a trigram with a name it sits inside, so scan for it
+            pool.update(i for i, name in enumerate(self.names) if search in name)
+
+        for rule in (lambda i: search in self.names[i],
+                     lambda i: self.names[i] in search,
+                     lambda i: bool(words & self.name_tokens[i])):
+            matches = [i for i in pool if rule(i)]
+            if len(matches) == 1:
+                return self.students[matches[0]], []
+
+        scored = sorted(((2 * shared_grams[i] / (len(grams) + len(self.name_grams[i])), i) for i in pool),
+                        key=lambda entry: (-entry[0], self.names[entry[1]]))
+        if scored:
+            best = scored[0][0]
+            runner_up = scored[1][0] if len(scored) > 1 else 0
+            if best >= self.FUZZY_THRESHOLD and best - runner_up >= self.FUZZY_MARGIN:
+                return self.students[scored[0][1]], []
+        return None, [self.students[i] for score, i in scored[:5] if score >= self.FUZZY_THRESHOLD / 2]
+
+_student_name_indexes = {}
+_student_name_indexes_lock = threading.Lock()
+
+def get_student_name_index(class_arm_id, session):
+    """Cached StudentNameIndex for a class arm and session.
+
+    The index is rebuilt when the roster's revision, bumped by triggers
+    on enrolment changes and renames, moves on.
+    """
     db = get_db()
     cursor = db.cursor()
+    cursor.execute("SELECT revision FROM roster_revisions WHERE class_arm_id = ? AND session = ?",
+                   (class_arm_id, session))
+    row = cursor.fetchone()
+    revision = row['revision'] if row else 0
+
+    key = (app.config['DATABASE'], int(class_arm_id), session)
+    with _student_name_indexes_lock:
+        cached = _student_name_indexes.get(key)
+    if cached and cached[0] == revision:
+        return cached[1]
 
     # Get all students in the class
     cursor.execute("""
@@ -1576,45 +2712,13 @@ def get_best_student_match(class_arm_id, session, full_name):
         JOIN class_arms a ON sc.class_arm_id = a.id
         JOIN classes c ON a.class_id = c.id
         WHERE sc.class_arm_id = ? AND sc.session = ?
+        GROUP BY s.id
     """, (class_arm_id, session))
-    
-    all_students = cursor.fetchall()
-    
-    if not all_students:
-        return None
-    
-    # Convert to list of dictionaries
-    students = [dict(student) for student in all_students]
-    
-    search_lower = search_name.lower()
-    
-    # Try exact match first
-    for student in students:
-        if student['full_name'].lower() == search_lower:
-            return student
-    
-    # Try contains match
-    contains_matches = [s for s in students if search_lower in s['full_name'].lower()]
-    if len(contains_matches) == 1:
-        return contains_matches[0]
-    
-    # Try reverse contains (search term contains student name)
-    reverse_matches = [s for s in students if s['full_name'].lower() in search_lower]
-    if len(reverse_matches) == 1:
-        return reverse_matches[0]
-    
-    # Try word-based matching
-    search_words = set(search_lower.split())
-    word_matches = []
-    for student in students:
-        student_words = set(student['full_name'].lower().split())
-        if search_words.intersection(student_words):
-            word_matches.append(student)
-    
-    if len(word_matches) == 1:
-        return word_matches[0]
-    
-    return None
+    index = StudentNameIndex(cursor.fetchall())
+
+    with _student_name_indexes_lock:
+        _student_name_indexes[key] = (revision, index)
+    return index
 
 @app.route('/generate-reports', methods=['GET', 'POST'])
 def generate_reports():
@@ -1627,219 +2731,76 @@ def generate_reports():
         term = int(request.form['term'])
         session = request.form['session']
         report_type = request.form.get('report_type', 'full_term')
+        output_format = request.form.get('output_format', 'zip')
+        bookmarks = bool(request.form.get('bookmarks'))
+
+        if report_type not in ('half_term', 'full_term') or output_format not in ('zip', 'booklet'):
+            return render_template("error.html", message="Invalid report type or output format.")
+
+        # --- Whole School: always a background job ---
+        if class_arm_id == 'all':
+            if full_name:
+                return render_template("error.html", message="Choose a class to generate a single student's report.")
+            job_id = enqueue_report_job(None, term, session, report_type, output_format, bookmarks)
+            return redirect(url_for('report_job_page', job_id=job_id))
         
-        cursor.execute("SELECT class_id FROM class_arms WHERE id = ?", (class_arm_id,))
-        class_result = cursor.fetchone()
-        class_id = class_result['class_id']
-
-        cursor.execute("SELECT level FROM classes WHERE id = ?", (class_id,))
-        level = cursor.fetchone()
-        class_level = level['level']
-
-        results = []
-
-        results = cursor.execute("""
-                SELECT s.id, s.full_name, s.reg_number, c.name || ' ' || a.arm AS class_name,
-                    AVG(sc.total_score) AS average
-                FROM students s
-                JOIN scores sc ON s.id = sc.student_id
-                JOIN student_classes x ON s.id = x.student_id
-                JOIN class_arms a ON x.class_arm_id = a.id
-                JOIN classes c ON a.class_id = c.id
-                WHERE a.class_id = ? AND x.term = ? AND x.session = ? AND sc.report_type = ?
-                GROUP BY s.id
-                ORDER BY average DESC
-            """, (class_id, term, session, report_type)).fetchall()
-
-        class_avg = sum(r["average"] for r in results)/len(results) if results else 0
-
-        # Convert to list of tuples (student_id, average)
-        entries = [(row['id'], row['average']) for row in results]
-
-        # Sort by highest average
-        entries_sorted = sorted(entries, key=lambda x: x[1], reverse=True)
-
-        # Assign positions (1st, 2nd, 3rd…)
-        rankings = {}
-        position = 1
-
-        for i, (student_id, avg) in enumerate(entries_sorted):
-            # Handle ties: if same score as previous student, same rank
-            if i > 0 and avg == entries_sorted[i - 1][1]:
-                rankings[student_id] = rankings[entries_sorted[i - 1][0]]
-            else:
-                rankings[student_id] = position
-            
-            position += 1
-
         # --- Single Student Report ---
         if full_name:
-            student = get_best_student_match(class_arm_id, session, full_name)
-            print(student)
+            student, candidates = get_student_name_index(class_arm_id, session).match(full_name)
 
             if not student:
+                if len(candidates) == 1:
+                    return render_template("error.html", message=f"No exact match for '{full_name}'; "
+                                                                 f"did you mean {candidates[0]['full_name']}?")
+                if candidates:
+                    names = ", ".join(candidate['full_name'] for candidate in candidates)
+                    return render_template("error.html", message=f"More than one student could be '{full_name}': {names}")
                 return render_template("error.html", message="No student found")
 
-            cursor.execute("""
-                    SELECT sub.name AS subject, 
-                           sc.ca1_score, sc.ca2_score, sc.ca3_score, sc.ca4_score, 
-                           sc.exam_score, sc.total_score, sc.report_type
-                    FROM scores sc
-                    JOIN subjects sub ON sc.subject_id = sub.id
-                    WHERE sc.student_id = ? AND sc.term = ? AND sc.session = ? AND sc.report_type = ?
-                """, (student["id"], term, session, report_type))
-            scores = cursor.fetchall()
-
-            if not scores:
+            report = load_class_report_contexts(class_arm_id, term, session, report_type).get(student["id"])
+            if not report or not report[1]["scores"]:
                 return render_template("error.html", message="No results found")
 
-            cursor.execute("""
-                    SELECT days_present, days_absent, days_late, total_school_days
-                    FROM attendance_summary 
-                    WHERE student_id = ? AND class_arm_id = ? AND term = ? AND session = ?
-                """, (student['id'], class_arm_id, term, session))
-            attendance_summary = cursor.fetchone()
-
-            cursor.execute("""
-                SELECT handwriting, sports_participation, practical_skills,
-                    punctuality, politeness, neatness,
-                    class_teacher_comment, principal_comment
-                FROM student_assessments
-                WHERE student_id = ? AND class_arm_id = ? AND term = ? AND session = ?
-            """, (student["id"], class_arm_id, term, session))
-            assessment = cursor.fetchone()
-
-            cursor.execute('''SELECT sk.name, ss.score
-                FROM student_skills ss
-                JOIN skills sk ON ss.skill_id = sk.id
-                WHERE ss.student_id = ? AND ss.term = ? AND ss.session = ?''', (student["id"], term, session))
-            skills = cursor.fetchone()
+            if request.form.get('output') == 'pdf':
+                return send_report_pdf(report)
 
-            total = sum(r["total_score"] for r in scores)
-            average = total / len(scores)
-
-            student_position = rankings.get(student['id'], None)
-
-            if class_level == "JSS":
-                position = student_position
-                grade = None
-            else:
-                position = None
-                grade = grade_from_average(average)
-
-
-            # Choose template based on report type
-            template_name = "half_term_report.html" if report_type == "half_term" else "full_term_report.html"
-            logo_path = os.path.join(app.root_path, 'static', 'kembos_logo_nobg.png')
-
-            # html_content = render_template(template_name,
-            #                                student=student,
-            #                                class_name=student["class_name"],
-            #                                scores=scores,
-            #                                term=term,
-            #                                logo_path=logo_path,
-            #                                photo_path=photo_path,
-            #                                session=session,
-            #                                average=average,
-            #                                report_type=report_type,
-            #                                attendance_summary=attendance_summary,
-            #                                year=datetime.now().year,
-            #                                current_date=datetime.now().strftime("%Y-%m-%d"))
-
-            # pdf_file = f"{student['full_name']}_report.pdf"
-            # pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], pdf_file)
-            # HTML(string=html_content, base_url=request.host_url).write_pdf(pdf_path)
-
-            # return send_file(pdf_path, as_attachment=True)
-
-            return render_template(template_name,
-                                           student=student,
-                                           class_name=student["class_name"],
-                                           scores=scores,
-                                           term=term,
-                                           logo_path=logo_path,
-                                           session=session,
-                                           average=average,
-                                           class_average=class_avg,
-                                           position=position,
-                                           grade=grade,
-                                           report_type=report_type,
-                                           skills=skills,
-                                           attendance_summary=attendance_summary,
-                                           assessment=assessment,
-                                           year=datetime.now().year,
-                                           current_date=datetime.now().strftime("%Y-%m-%d"))
+            template_name, context = report
+            return render_template(template_name, **context)
 
        # --- Whole Class Batch Reports ---
-        cursor.execute("""
-            SELECT s.id, s.reg_number, s.full_name, s.age, s.photo, 
-                c.name || ' ' || a.arm AS class_name
-            FROM students s
-            JOIN student_classes sc ON s.id = sc.student_id
-            JOIN class_arms a ON sc.class_arm_id = a.id
-            JOIN classes c ON a.class_id = c.id
-            WHERE sc.class_arm_id = ? AND sc.session = ?
-            ORDER BY s.full_name
-        """, (class_arm_id, session))
-        students = cursor.fetchall()
+        students = get_class_report_students(class_arm_id, session)
 
         if not students:
             return render_template("error.html", message="No students found for this class/year")
 
-        report_type = request.form.get("report_type", "full_term")
+        if app.config['REPORT_BATCH_MODE'] == 'queue':
+            job_id = enqueue_report_job(class_arm_id, term, session, report_type, output_format, bookmarks)
+            return redirect(url_for('report_job_page', job_id=job_id))
 
         # Sanitize ZIP filename
         safe_session = session.replace("/", "_")
-        zip_filename = f"class_{class_arm_id}_term{term}_{safe_session}_reports.zip"
-
-        # Prepare in-memory ZIP buffer
-        zip_buffer = BytesIO()
-
-        # Detect your current host (local or LAN)
-        host_url = request.host_url.rstrip('/')
 
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            context = browser.new_context()
-            
-            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-                for student in students:
-                    reg_number = student["reg_number"]
-                    
-                    # Construct the exact URL for the student's report page
-                    report_url = f"{host_url}/preview-report?student_id={student['id']}&term={term}&session={session}&report_type={report_type}"
-                    
-                    pdf_filename = f"{student['full_name'].replace(' ', '_')}_report.pdf"
-                    pdf_path = os.path.join(tempfile.gettempdir(), pdf_filename)
-                    
-                    page = context.new_page()
-                    print(f"🧾 Generating PDF for {student['full_name']} ({report_type})")
-                    
-                    try:
-                        page.goto(report_url, wait_until="networkidle")
-                        page.pdf(
-                            path=pdf_path,
-                            format="A4",
-                            print_background=True,
-                            margin={"top": "10mm", "bottom": "10mm", "left": "10mm", "right": "10mm"}
-                        )
-                        zf.write(pdf_path, pdf_filename)
-                    except Exception as e:
-                        print(f"❌ Error generating report for {student['full_name']}: {e}")
-                    finally:
-                        if os.path.exists(pdf_path):
-                            os.remove(pdf_path)
-                        page.close()
-            
-            browser.close()
+        # --- Whole class as one booklet PDF ---
+        if output_format == 'booklet':
+            print(f"🧾 Generating booklet of {len(students)} reports for class {class_arm_id} ({report_type})")
+            try:
+                pdf, _ = write_class_booklet(class_arm_id, term, session, report_type, bookmarks)
+            except Exception as e:
+                return render_template("error.html", message=f"Could not generate booklet: {e}")
+            return send_file(
+                BytesIO(pdf),
+                as_attachment=True,
+                download_name=f"class_{class_arm_id}_term{term}_{safe_session}_reports.pdf",
+                mimetype="application/pdf"
+            )
+        zip_filename = f"class_{class_arm_id}_term{term}_{safe_session}_reports.zip"
 
-        # Return ZIP as downloadable file
-        zip_buffer.seek(0)
-        return send_file(
-            zip_buffer,
-            as_attachment=True,
-            download_name=zip_filename,
-            mimetype="application/zip"
+        # Stream the ZIP as each student's PDF is ready
+        print(f"🧾 Generating {len(students)} PDFs for class {class_arm_id} ({report_type})")
+        return Response(
+            stream_with_context(stream_class_reports_zip(class_arm_id, term, session, report_type)),
+            mimetype="application/zip",
+            headers={"Content-Disposition": f"attachment; filename={zip_filename}"}
         )
 
 
@@ -1891,150 +2852,1383 @@ def grade_from_average(avg):
     elif avg >= 60:
         return "C+"
 
-@app.route("/preview-report")
-def preview_report():
-    student_id = request.args.get("student_id")
-    term = request.args.get("term")
-    session = request.args.get("session")
-    report_type = request.args.get("report_type", "full_term")
+RANKING_SCOPES = {'class': 'a.class_id', 'arm': 'x.class_arm_id'}
 
-    if not student_id or not term or not session:
-        return "Missing parameters", 400
+def rank_students(scope, term, session, report_type, scope_id=None):
+    """Rank students by average score in one statement using window functions.
+
+    scope 'class' ranks across all arms of a class (the JSS rule) and 'arm'
+    within each class arm; scope_id limits the ranking to one class or arm.
+    Tied averages share a position: `position` skips after a tie (1, 1, 3)
+    and `dense_position` does not (1, 1, 2). Each row also carries the
+    scope's class_average and student_count.
+    """
+    column = RANKING_SCOPES[scope]
+    params = [term, session, report_type]
+    scope_filter = ""
+    if scope_id is not None:
+        scope_filter = f"AND {column} = ?"
+        params.append(scope_id)
+
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute(f"""
+        WITH averages AS (
+            SELECT {column} AS scope_id, x.student_id, AVG(sc.total_score) AS average
+            FROM student_classes x
+            JOIN class_arms a ON a.id = x.class_arm_id
+            JOIN scores sc ON sc.student_id = x.student_id
+                AND sc.term = x.term AND sc.session = x.session
+            WHERE x.term = ? AND x.session = ? AND sc.report_type = ? {scope_filter}
+            GROUP BY {column}, x.student_id
+        )
+        SELECT scope_id, student_id, average,
+               RANK() OVER ranked AS position,
+               DENSE_RANK() OVER ranked AS dense_position,
+               AVG(average) OVER (PARTITION BY scope_id) AS class_average,
+               COUNT(*) OVER (PARTITION BY scope_id) AS student_count
+        FROM averages
+        WINDOW ranked AS (PARTITION BY scope_id ORDER BY average DESC)
+        ORDER BY scope_id, position
+    """, params)
+    return cursor.fetchall()
+
+def mark_rankings_built(cursor, ranking, scope, scope_id, term, session, report_type):
+    """Record that a scope's rankings are current, even when it has no rows."""
+    cursor.execute("""
+        INSERT OR REPLACE INTO ranking_builds (ranking, scope, scope_id, term, session, report_type, built_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (ranking, scope, scope_id, term, session, report_type, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+def rankings_built(db, ranking, scope, scope_id, term, session, report_type):
+    return db.execute("""
+        SELECT 1 FROM ranking_builds
+        WHERE ranking = ? AND scope = ? AND scope_id = ? AND term = ? AND session = ? AND report_type = ?
+    """, (ranking, scope, scope_id, term, session, report_type)).fetchone() is not None
+
+def rebuild_class_rankings(scope, scope_id, term, session, report_type):
+    """Recompute and store the positions for one ranking scope."""
+    db = get_db()
+    cursor = db.cursor()
+    # Read and write in one transaction so a score saved meanwhile is not
+    # overwritten; inside a caller's transaction, commit nothing on its behalf
+    owns_transaction = not db.in_transaction
+    if owns_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+    else:
+        cursor.execute("SAVEPOINT rebuild_rankings")
+    try:
+        rows = rank_students(scope, term, session, report_type, scope_id)
+        cursor.execute("""
+            DELETE FROM class_rankings
+            WHERE scope = ? AND scope_id = ? AND term = ? AND session = ? AND report_type = ?
+        """, (scope, scope_id, term, session, report_type))
+        cursor.executemany("""
+            INSERT INTO class_rankings
+            (scope, scope_id, term, session, report_type, student_id,
+             average, position, dense_position, class_average, student_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(scope, scope_id, term, session, report_type, row['student_id'], row['average'],
+               row['position'], row['dense_position'], row['class_average'], row['student_count'])
+              for row in rows])
+        mark_rankings_built(cursor, 'class', scope, scope_id, term, session, report_type)
+        if owns_transaction:
+            db.commit()
+        else:
+            cursor.execute("RELEASE rebuild_rankings")
+    except Exception:
+        if owns_transaction:
+            db.rollback()
+        else:
+            cursor.execute("ROLLBACK TO rebuild_rankings")
+            cursor.execute("RELEASE rebuild_rankings")
+        raise
+
+def get_class_rankings(scope, scope_id, term, session, report_type):
+    """Stored positions for a class or arm, rebuilt first if its scores changed since.
+
+    Returns {student_id: row} with average, position, dense_position,
+    class_average and student_count.
+    """
+    db = get_db()
+    query = """
+        SELECT student_id, average, position, dense_position, class_average, student_count
+        FROM class_rankings
+        WHERE scope = ? AND scope_id = ? AND term = ? AND session = ? AND report_type = ?
+    """
+    params = (scope, scope_id, term, session, report_type)
+    if not rankings_built(db, 'class', *params):
+        rebuild_class_rankings(*params)
+    return {row['student_id']: row for row in db.execute(query, params).fetchall()}
+
+def rank_subjects(scope, scope_id, term, session, report_type):
+    """Every student's position in each subject, with the subject's highest,
+    lowest and average score, for one class or arm in a single windowed query.
+    """
+    column = RANKING_SCOPES[scope]
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute(f"""
+        SELECT sc.subject_id, sc.student_id,
+               RANK() OVER ranked AS position,
+               MAX(sc.total_score) OVER by_subject AS highest,
+               MIN(sc.total_score) OVER by_subject AS lowest,
+               AVG(sc.total_score) OVER by_subject AS average,
+               COUNT(*) OVER by_subject AS student_count
+        FROM scores sc
+        WHERE sc.term = ? AND sc.session = ? AND sc.report_type = ?
+          AND sc.total_score IS NOT NULL
+          AND sc.student_id IN (
+              SELECT x.student_id
+              FROM student_classes x
+              JOIN class_arms a ON a.id = x.class_arm_id
+              WHERE x.term = ? AND x.session = ? AND {column} = ?
+          )
+        WINDOW by_subject AS (PARTITION BY sc.subject_id),
+               ranked AS (PARTITION BY sc.subject_id ORDER BY sc.total_score DESC)
+    """, (term, session, report_type, term, session, scope_id))
+    return cursor.fetchall()
+
+def rebuild_subject_rankings(scope, scope_id, term, session, report_type):
+    """Recompute and store the subject positions for one ranking scope."""
+    db = get_db()
+    cursor = db.cursor()
+    owns_transaction = not db.in_transaction
+    if owns_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+    else:
+        cursor.execute("SAVEPOINT rebuild_rankings")
+    try:
+        rows = rank_subjects(scope, scope_id, term, session, report_type)
+        cursor.execute("""
+            DELETE FROM subject_rankings
+            WHERE scope = ? AND scope_id = ? AND term = ? AND session = ? AND report_type = ?
+        """, (scope, scope_id, term, session, report_type))
+        cursor.executemany("""
+            INSERT INTO subject_rankings
+            (scope, scope_id, term, session, report_type, subject_id, student_id,
+             position, highest, lowest, average, student_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(scope, scope_id, term, session, report_type, row['subject_id'], row['student_id'],
+               row['position'], row['highest'], row['lowest'], row['average'], row['student_count'])
+              for row in rows])
+        mark_rankings_built(cursor, 'subject', scope, scope_id, term, session, report_type)
+        if owns_transaction:
+            db.commit()
+        else:
+            cursor.execute("RELEASE rebuild_rankings")
+    except Exception:
+        if owns_transaction:
+            db.rollback()
+        else:
+            cursor.execute("ROLLBACK TO rebuild_rankings")
+            cursor.execute("RELEASE rebuild_rankings")
+        raise
+
+def get_subject_rankings(scope, scope_id, term, session, report_type):
+    """Stored subject positions for a class or arm, rebuilt first if its scores changed since.
 
+    Returns {student_id: {subject_id: row}} with position, highest, lowest,
+    average and student_count.
+    """
+    db = get_db()
+    query = """
+        SELECT subject_id, student_id, position, highest, lowest, average, student_count
+        FROM subject_rankings
+        WHERE scope = ? AND scope_id = ? AND term = ? AND session = ? AND report_type = ?
+    """
+    params = (scope, scope_id, term, session, report_type)
+    if not rankings_built(db, 'subject', *params):
+        rebuild_subject_rankings(*params)
+
+    rankings = defaultdict(dict)
+    for row in db.execute(query, params).fetchall():
+        rankings[row['student_id']][row['subject_id']] = row
+    return rankings
+
+def load_class_report_contexts(class_arm_id, term, session, report_type="full_term"):
+    """Gather report data for every student in a class arm in one pass.
+
+    Scores, attendance, assessments, skills and class and subject rankings are each
+    fetched with one set-based query for the whole arm. Returns
+    {student_id: (template_name, context)} ordered by full_name.
+    """
     db = get_db()
     cursor = db.cursor()
 
-    # Get student info
     cursor.execute("""
+        SELECT a.class_id, c.level
+        FROM class_arms a
+        JOIN classes c ON a.class_id = c.id
+        WHERE a.id = ?
+    """, (class_arm_id,))
+    class_info = cursor.fetchone()
+    if not class_info:
+        return {}
+
+    # Students enrolled in this arm for the session
+    roster = "SELECT student_id FROM student_classes WHERE class_arm_id = ? AND session = ?"
+
+    cursor.execute(f"""
         SELECT s.id, s.reg_number, s.full_name, s.age, s.photo, 
                c.name || ' ' || a.arm AS class_name, s.department_id, s.gender
         FROM students s
-        JOIN student_classes sc ON s.id = sc.student_id
-        JOIN class_arms a ON sc.class_arm_id = a.id
+        JOIN class_arms a ON a.id = ?
         JOIN classes c ON a.class_id = c.id
-        WHERE s.id = ? AND sc.session = ?
-    """, (student_id, session))
-    student = cursor.fetchone()
-    if not student:
-        return "Student not found", 404
+        WHERE s.id IN ({roster})
+        ORDER BY s.full_name
+    """, (class_arm_id, class_arm_id, session))
+    students = cursor.fetchall()
 
-    # Get scores
-    cursor.execute("""
-        SELECT sub.name AS subject, 
+    scores = defaultdict(list)
+    cursor.execute(f"""
+        SELECT sc.student_id, sc.subject_id, sub.name AS subject, 
                sc.ca1_score, sc.ca2_score, sc.ca3_score, sc.ca4_score,
                sc.exam_score, sc.total_score
         FROM scores sc
         JOIN subjects sub ON sc.subject_id = sub.id
-        WHERE sc.student_id = ? AND sc.term = ? AND sc.session = ? AND sc.report_type = ?
-    """, (student_id, term, session, report_type))
-    scores = cursor.fetchall()
+        WHERE sc.student_id IN ({roster}) AND sc.term = ? AND sc.session = ? AND sc.report_type = ?
+        ORDER BY sc.student_id, sc.subject_id
+    """, (class_arm_id, session, term, session, report_type))
+    for row in cursor.fetchall():
+        scores[row['student_id']].append(row)
 
-    # Get attendance
     cursor.execute("""
-        SELECT days_present, days_absent, days_late, total_school_days
+        SELECT student_id, days_present, days_absent, days_late, total_school_days
         FROM attendance_summary 
-        WHERE student_id = ? AND class_arm_id = (
-            SELECT class_arm_id FROM student_classes 
-            WHERE student_id = ? AND session = ?
-        )
-        AND term = ? AND session = ?
-    """, (student_id, student_id, session, term, session))
-    attendance_summary = cursor.fetchone()
+        WHERE class_arm_id = ? AND term = ? AND session = ?
+    """, (class_arm_id, term, session))
+    attendance = {row['student_id']: row for row in cursor.fetchall()}
 
-    cursor.execute("""
-        SELECT handwriting, sports_participation, practical_skills,
+    cursor.execute(f"""
+        SELECT student_id, handwriting, sports_participation, practical_skills,
             punctuality, politeness, neatness,
             class_teacher_comment, principal_comment
         FROM student_assessments
-        WHERE student_id = ? AND term = ? AND session = ?
-    """, (student["id"], term, session))
-    assessment = cursor.fetchone()
+        WHERE student_id IN ({roster}) AND term = ? AND session = ?
+        ORDER BY id DESC
+    """, (class_arm_id, session, term, session))
+    assessments = {row['student_id']: row for row in cursor.fetchall()}
 
-    cursor.execute('''SELECT sk.name, ss.score
+    cursor.execute(f'''SELECT ss.student_id, sk.name, ss.score
                 FROM student_skills ss
                 JOIN skills sk ON ss.skill_id = sk.id
-                WHERE ss.student_id = ? AND ss.term = ? AND ss.session = ?''', (student["id"], term, session))
-    skills = cursor.fetchone()
-    
+                WHERE ss.student_id IN ({roster}) AND ss.term = ? AND ss.session = ?
+                ORDER BY ss.id DESC''', (class_arm_id, session, term, session))
+    skills = {row['student_id']: row for row in cursor.fetchall()}
+
+    scope = app.config['REPORT_POSITION_SCOPE']
+    scope_id = class_info['class_id'] if scope == 'class' else class_arm_id
+    rankings = get_class_rankings(scope, scope_id, term, session, report_type)
+    subject_rankings = get_subject_rankings(scope, scope_id, term, session, report_type)
+    class_avg = next(iter(rankings.values()))['class_average'] if rankings else 0
+
+    template_name = "full_term_report.html" if report_type == "full_term" else "half_term_report.html"
+    logo_path = os.path.join(app.root_path, 'static', 'kembos_logo_nobg.png')
+
+    reports = {}
+    for student in students:
+        student_scores = scores[student['id']]
+        # Blank totals are left out, as AVG() leaves them out of the stored rankings
+        totals = [r["total_score"] for r in student_scores if r["total_score"] is not None]
+        average = sum(totals) / len(totals) if totals else 0
+
+        if class_info['level'] == "JSS":
+            position = rankings[student["id"]]['position'] if student["id"] in rankings else None
+            grade = None
+        else:
+            position = None
+            grade = grade_from_average(average)
+
+        reports[student['id']] = (template_name, dict(student=student,
+                                                      class_name=student["class_name"],
+                                                      scores=student_scores,
+                                                      subject_stats=subject_rankings.get(student['id'], {}),
+                                                      term=term,
+                                                      session=session,
+                                                      logo_path=logo_path,
+                                                      class_average=class_avg,
+                                                      position=position,
+                                                      grade=grade,
+                                                      skills=skills.get(student['id']),
+                                                      average=average,
+                                                      report_type=report_type,
+                                                      attendance_summary=attendance.get(student['id']),
+                                                      assessment=assessments.get(student['id']),
+                                                      year=datetime.now().year,
+                                                      current_date=datetime.now().strftime("%Y-%m-%d")))
+    return reports
+
+def build_report_context(student_id, term, session, report_type="full_term"):
+    """Report (template_name, context) for one student, or None if not enrolled."""
+    db = get_db()
+    cursor = db.cursor()
     cursor.execute("""
         SELECT class_arm_id
         FROM student_classes
-        WHERE student_id = ?
-    """, (student["id"],))
-    class_arm = cursor.fetchone()
+        WHERE student_id = ? AND session = ?
+        ORDER BY term = ? DESC, term DESC
+    """, (student_id, session, term))
+    enrolment = cursor.fetchone()
+    if not enrolment:
+        return None
+
+    return load_class_report_contexts(enrolment['class_arm_id'], term, session, report_type).get(student_id)
 
-    cursor.execute("SELECT class_id FROM class_arms WHERE id = ?", (class_arm['class_arm_id'],))
-    class_result = cursor.fetchone()
-    class_id = class_result['class_id']
+@app.route("/preview-report")
+def preview_report():
+    student_id = request.args.get("student_id", type=int)
+    term = request.args.get("term", type=int)
+    session = request.args.get("session")
+    report_type = request.args.get("report_type", "full_term")
 
-    cursor.execute("SELECT level FROM classes WHERE id = ?", (class_id,))
-    level = cursor.fetchone()
-    class_level = level['level']
+    if not student_id or not term or not session:
+        return "Missing parameters", 400
 
-    results = []
+    report = build_report_context(student_id, term, session, report_type)
+    if not report:
+        return "Student not found", 404
 
-    results = cursor.execute("""
-                SELECT s.id, s.full_name, s.reg_number, c.name || ' ' || a.arm AS class_name,
-                    AVG(sc.total_score) AS average
-                FROM students s
-                JOIN scores sc ON s.id = sc.student_id
-                JOIN student_classes x ON s.id = x.student_id
-                JOIN class_arms a ON x.class_arm_id = a.id
-                JOIN classes c ON a.class_id = c.id
-                WHERE a.class_id = ? AND x.term = ? AND x.session = ? AND sc.report_type = ?
-                GROUP BY s.id
-                ORDER BY average DESC
-            """, (class_id, term, session, report_type)).fetchall()
+    template_name, context = report
+    return render_template(template_name, **context)
 
-    # Convert to list of tuples (student_id, average)
-    entries = [(row['id'], row['average']) for row in results]
+@app.route("/download-report")
+def download_report():
+    """A student's report as a PDF, served from the report cache when unchanged."""
+    student_id = request.args.get("student_id", type=int)
+    term = request.args.get("term", type=int)
+    session = request.args.get("session")
+    report_type = request.args.get("report_type", "full_term")
+
+    if not student_id or not term or not session:
+        return "Missing parameters", 400
 
-    # Sort by highest average
-    entries_sorted = sorted(entries, key=lambda x: x[1], reverse=True)
+    report = build_report_context(student_id, term, session, report_type)
+    if not report:
+        return "Student not found", 404
 
-    # Assign positions (1st, 2nd, 3rd…)
-    rankings = {}
-    position = 1
+    return send_report_pdf(report)
+
+def send_report_pdf(report):
+    pdf, error = next(get_report_pdfs([report]))
+    if error:
+        return render_template("error.html", message=f"Could not generate report: {error}")
+
+    student = report[1]['student']
+    return send_file(
+        BytesIO(pdf),
+        as_attachment=True,
+        download_name=f"{student['full_name'].replace(' ', '_')}_report.pdf",
+        mimetype="application/pdf"
+    )
+
+# -------------------------
+# In-process PDF rendering
+# -------------------------
+def resolve_report_asset(url):
+    """Map a URL requested by a report page to a file on disk.
+
+    Report pages reference /static/... and /uploads/photos/... paths; these
+    are read straight from disk so rendering never goes back through the
+    web server. Returns None for anything outside those folders.
+    """
+    base_url = app.config['REPORT_ASSET_BASE_URL']
+    if not url.startswith(base_url):
+        return None
+
+    path = unquote(urlparse(url).path)
+    if path.startswith('/static/'):
+        folder, filename = app.static_folder, path[len('/static/'):]
+    elif path.startswith('/uploads/photos/'):
+        folder, filename = os.path.join(app.config['UPLOAD_FOLDER'], 'photos'), path[len('/uploads/photos/'):]
+    else:
+        return None
+
+    folder = os.path.abspath(folder)
+    file_path = os.path.abspath(os.path.join(folder, filename))
+    if not file_path.startswith(folder + os.sep) or not os.path.isfile(file_path):
+        return None
+    return file_path
+
+def render_report_html(template_name, context):
+    """Render a report template to an HTML string outside of any HTTP request."""
+    with app.test_request_context('/preview-report', base_url=app.config['REPORT_ASSET_BASE_URL']):
+        return render_template(template_name, **context)
+
+def report_url_fetcher(url, *args, **kwargs):
+    """WeasyPrint URL fetcher that serves report assets from disk."""
+    file_path = resolve_report_asset(url)
+    if file_path:
+        return default_url_fetcher(Path(file_path).as_uri(), *args, **kwargs)
+    return default_url_fetcher(url, *args, **kwargs)
+
+def html_to_pdf_weasyprint(html):
+    return HTML(string=html,
+                base_url=app.config['REPORT_ASSET_BASE_URL'] + 'preview-report',
+                url_fetcher=report_url_fetcher).write_pdf()
+
+def html_to_pdf_playwright(page, html, outline=False):
+    """Print an HTML string to PDF bytes with an already open Playwright page.
+
+    The page is pointed at the synthetic report origin and every request on
+    it is fulfilled in process: the document from `html`, assets from disk.
+    With `outline`, Chromium adds PDF bookmarks built from the headings.
+    """
+    base_url = app.config['REPORT_ASSET_BASE_URL']
+    document_url = base_url + 'preview-report'
+
+    def handle_route(route):
+        url = route.request.url
+        if url == document_url:
+            return route.fulfill(status=200, content_type="text/html; charset=utf-8", body=html)
+        file_path = resolve_report_asset(url)
+        if file_path:
+            return route.fulfill(path=file_path)
+        return route.abort()
+
+    page.route(base_url + "**", handle_route)
+    try:
+        page.goto(document_url, wait_until="load")
+        return page.pdf(
+            format="A4",
+            print_background=True,
+            margin={"top": "10mm", "bottom": "10mm", "left": "10mm", "right": "10mm"},
+            outline=outline,
+            tagged=outline
+        )
+    finally:
+        page.unroute(base_url + "**")
+
+class BrowserPool:
+    """Warm headless Chromium instances shared by every request in a worker process.
+
+    Playwright's sync API ties a browser to the thread that launched it, so
+    each browser lives on its own renderer thread and is handed work through
+    a queue. `size` caps how many pages render at once. A browser is
+    relaunched after `max_renders` pages, when it stops responding, or after
+    a render fails.
+    """
+
+    def __init__(self, size=1, max_renders=200):
+        self.size = size
+        self.max_renders = max_renders
+        self.pid = os.getpid()
+        self.launches = 0
+        self.renders = 0
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._run, name=f"report-browser-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, html, **pdf_options):
+        """Queue an HTML document for printing; returns a Future of PDF bytes.
+
+        `pdf_options` are passed on to html_to_pdf_playwright.
+        """
+        if self._closed:
+            raise RuntimeError("Browser pool is closed")
+        future = Future()
+        self._tasks.put((html, pdf_options, future))
+        return future
+
+    def render(self, html, **pdf_options):
+        return self.submit(html, **pdf_options).result()
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'alive': sum(thread.is_alive() for thread in self._threads),
+            'launches': self.launches,
+            'renders': self.renders,
+            'queued': self._tasks.qsize(),
+        }
+
+    def close(self, timeout=10):
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        playwright = None
+        browser = page = None
+        renders = 0
+        try:
+            while True:
+                task = self._tasks.get()
+                if task is None:
+                    break
+                html, pdf_options, future = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                try:
+                    if playwright is None:
+                        playwright = sync_playwright().start()
+
+                    # Health check / recycle before handing out the page
+                    if browser is None or not browser.is_connected() or renders >= self.max_renders:
+                        self._close_browser(browser)
+                        browser = playwright.chromium.launch(headless=True)
+                        page = browser.new_page()
+                        renders = 0
+                        with self._lock:
+                            self.launches += 1
+                    elif page.is_closed():
+                        page = browser.new_page()
+
+                    pdf = html_to_pdf_playwright(page, html, **pdf_options)
+                    renders += 1
+                    with self._lock:
+                        self.renders += 1
+                    future.set_result(pdf)
+                except Exception as e:
+                    # Start the next render from a fresh browser
+                    self._close_browser(browser)
+                    browser = page = None
+                    future.set_exception(e)
+        finally:
+            self._close_browser(browser)
+            if playwright is not None:
+                playwright.stop()
+
+    @staticmethod
+    def _close_browser(browser):
+        if browser is None:
+            return
+        try:
+            browser.close()
+        except Exception:
+            pass
+
+_browser_pool = None
+_browser_pool_lock = threading.Lock()
+
+def get_browser_pool():
+    """Return this worker process's browser pool, starting it on first use."""
+    global _browser_pool
+    with _browser_pool_lock:
+        # A pool inherited across fork() has no renderer threads in this process
+        if _browser_pool is None or _browser_pool.pid != os.getpid():
+            _browser_pool = BrowserPool(size=app.config['REPORT_BROWSER_POOL_SIZE'],
+                                        max_renders=app.config['REPORT_BROWSER_MAX_RENDERS'])
+        return _browser_pool
+
+@atexit.register
+def close_browser_pool():
+    global _browser_pool
+    with _browser_pool_lock:
+        if _browser_pool is not None and _browser_pool.pid == os.getpid():
+            _browser_pool.close()
+        _browser_pool = None
+
+_pdf_process_pool = None
+_pdf_process_pool_pid = None
+
+def get_pdf_process_pool():
+    """Return this worker process's pool of WeasyPrint processes."""
+    global _pdf_process_pool, _pdf_process_pool_pid
+    with _browser_pool_lock:
+        if _pdf_process_pool is None or _pdf_process_pool_pid != os.getpid():
+            _pdf_process_pool = ProcessPoolExecutor(max_workers=app.config['REPORT_RENDER_WORKERS'])
+            _pdf_process_pool_pid = os.getpid()
+        return _pdf_process_pool
+
+@atexit.register
+def close_pdf_process_pool():
+    global _pdf_process_pool
+    if _pdf_process_pool is not None and _pdf_process_pool_pid == os.getpid():
+        _pdf_process_pool.shutdown(cancel_futures=True)
+    _pdf_process_pool = None
+
+def render_report_pdfs(documents):
+    """Print HTML documents to PDF concurrently.
+
+    `documents` may be a lazy iterable. Twice as many documents as there are
+    renderers are kept in flight, so every page (or WeasyPrint process)
+    stays busy without a whole class being held in memory. Results are
+    yielded in the order of `documents` as (pdf_bytes, error) pairs, so
+    archives come out the same on every run.
+    """
+    if app.config['REPORT_RENDERER'] == 'weasyprint':
+        executor = get_pdf_process_pool()
+        submit = lambda html: executor.submit(html_to_pdf_weasyprint, html)
+        window = 2 * app.config['REPORT_RENDER_WORKERS']
+    else:
+        submit = get_browser_pool().submit
+        window = 2 * app.config['REPORT_BROWSER_POOL_SIZE']
+
+    documents = iter(documents)
+    pending = deque()
+    while True:
+        while len(pending) < window:
+            html = next(documents, None)
+            if html is None:
+                break
+            pending.append(submit(html))
+        if not pending:
+            return
+
+        future = pending.popleft()
+        try:
+            yield future.result(), None
+        except Exception as e:
+            yield None, e
+
+class ReportCache:
+    """Rendered report PDFs on disk, addressed by a hash of their inputs.
+
+    Files live under folder/<key[:2]>/<key>.pdf. Reads refresh a file's
+    mtime and writes evict the least recently used files once the folder
+    grows past max_bytes.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], f"{key}.pdf")
+
+    def contains(self, key):
+        return os.path.isfile(self.path(key))
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                pdf = f.read()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pdf
+
+    def put(self, key, pdf):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(pdf)
+        # Rewriting a cached key only changes the size by the difference
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, _, size in self._entries())
+            else:
+                self._size += len(pdf) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                if not name.endswith('.pdf'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self._size = sum(size for _, _, size in entries)
+        # Trim to 90% so every write past the limit does not rescan the folder
+        target = self.max_bytes * 0.9
+        for path, _, size in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                pass
+
+report_cache = ReportCache(app.config['REPORT_CACHE_FOLDER'], app.config['REPORT_CACHE_MAX_BYTES'])
+
+_template_digests = {}
+
+def report_template_digest(template_name):
+    """Hash of a report template's source, recomputed when the file changes."""
+    cached = _template_digests.get(template_name)
+    if cached and cached[1]():
+        return cached[0]
+    source, _, uptodate = app.jinja_env.loader.get_source(app.jinja_env, template_name)
+    digest = hashlib.sha256(source.encode()).hexdigest()
+    _template_digests[template_name] = (digest, uptodate or (lambda: False))
+    return digest
+
+def _report_cache_value(value):
+    if isinstance(value, sqlite3.Row):
+        return dict(value)
+    return str(value)
+
+def report_cache_key(template_name, context):
+    """Content hash of everything that ends up in a student's PDF."""
+    # current_date is not printed on the report and would change the key daily
+    payload = {key: value for key, value in context.items() if key != 'current_date'}
+
+    # Photos are re-uploaded under the same filename, so fingerprint the file itself
+    photo = context['student']['photo']
+    photo_stat = None
+    if photo:
+        photo_path = os.path.join(app.config['UPLOAD_FOLDER'], 'photos', photo)
+        if os.path.exists(photo_path):
+            stat = os.stat(photo_path)
+            photo_stat = [stat.st_mtime_ns, stat.st_size]
+
+    key_data = json.dumps({
+        'template': template_name,
+        'template_digest': report_template_digest(template_name),
+        'renderer': app.config['REPORT_RENDERER'],
+        'photo': photo_stat,
+        'context': payload,
+    }, sort_keys=True, default=_report_cache_value)
+    return hashlib.sha256(key_data.encode()).hexdigest()
+
+def load_report_revisions(class_arm_id, term, session):
+    """Current report input revision of every student in a class arm."""
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT student_id, revision
+        FROM report_input_revisions
+        WHERE term = ? AND session = ? AND student_id IN (
+            SELECT student_id FROM student_classes WHERE class_arm_id = ? AND session = ?
+        )
+    """, (term, session, class_arm_id, session))
+    return {row['student_id']: row['revision'] for row in cursor.fetchall()}
+
+def report_render_fingerprint(template_name, context):
+    """What a student's PDF depends on beyond their own revisioned inputs."""
+    return hashlib.sha256(json.dumps([
+        template_name,
+        report_template_digest(template_name),
+        app.config['REPORT_RENDERER'],
+        context['position'],
+        context['class_average'],
+        context['subject_stats'],
+        context['year'],
+    ], sort_keys=True, default=_report_cache_value).encode()).hexdigest()
+
+def get_report_pdfs(reports, revisions=None):
+    """PDFs for (template_name, context) pairs, reusing earlier renders.
+
+    With `revisions` (read *before* the contexts were loaded), a student
+    whose inputs and class standing are unchanged since their last render
+    reuses that PDF without hashing the context. Everything else goes
+    through the content-addressed cache, and only misses are rendered.
+    Yields (pdf_bytes, error) in the order of `reports`.
+    """
+    previous = {}
+    if revisions is not None and reports:
+        _, first = reports[0]
+        db = get_db()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT student_id, revision, fingerprint, cache_key
+            FROM report_renders
+            WHERE term = ? AND session = ? AND report_type = ?
+        """, (first['term'], first['session'], first['report_type']))
+        previous = {row['student_id']: row for row in cursor.fetchall()}
+
+    # Only look the PDFs up here; they are read one at a time as they are yielded
+    keys, fingerprints, cached = [], [], []
+    for template_name, context in reports:
+        student_id = context['student']['id']
+        fingerprint = report_render_fingerprint(template_name, context) if revisions is not None else None
+        last = previous.get(student_id)
+        key = None
+        # No revision row means the inputs are untracked, so the context must be hashed
+        revision = revisions.get(student_id) if revisions is not None else None
+        if last and revision is not None and last['revision'] == revision and last['fingerprint'] == fingerprint \
+                and report_cache.contains(last['cache_key']):
+            key = last['cache_key']
+        if key is None:
+            key = report_cache_key(template_name, context)
+        keys.append(key)
+        fingerprints.append(fingerprint)
+        cached.append(report_cache.contains(key))
+
+    misses = [i for i, hit in enumerate(cached) if not hit]
+    if revisions is not None:
+        print(f"♻️ Reusing {len(reports) - len(misses)} unchanged reports, rendering {len(misses)}")
+    rendered = render_report_pdfs(render_report_html(*reports[i]) for i in misses)
+
+    rendered_rows = []
+    try:
+        for i, key in enumerate(keys):
+            pdf = report_cache.get(key) if cached[i] else None
+            error = None
+            if pdf is None:
+                if cached[i]:
+                    # Evicted since the lookup above
+                    pdf, error = next(render_report_pdfs([render_report_html(*reports[i])]))
+                else:
+                    # Misses come back from the renderer in the same order
+                    pdf, error = next(rendered)
+                if not error:
+                    report_cache.put(key, pdf)
+
+            context = reports[i][1]
+            student_id = context['student']['id']
+            if revisions is not None and revisions.get(student_id) is not None and not error:
+                rendered_rows.append((student_id, context['term'], context['session'], context['report_type'],
+                                      revisions[student_id], fingerprints[i], key,
+                                      datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            yield pdf, error
+    finally:
+        if rendered_rows:
+            db = get_db()
+            db.executemany("""
+                INSERT OR REPLACE INTO report_renders
+                (student_id, term, session, report_type, revision, fingerprint, cache_key, rendered_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, rendered_rows)
+            db.commit()
+
+def get_class_report_students(class_arm_id, session):
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT DISTINCT s.id, s.reg_number, s.full_name, s.age, s.photo, 
+            c.name || ' ' || a.arm AS class_name
+        FROM students s
+        JOIN student_classes sc ON s.id = sc.student_id
+        JOIN class_arms a ON sc.class_arm_id = a.id
+        JOIN classes c ON a.class_id = c.id
+        WHERE sc.class_arm_id = ? AND sc.session = ?
+        ORDER BY s.full_name
+    """, (class_arm_id, session))
+    return cursor.fetchall()
+
+def iter_report_pdfs(class_arm_ids, term, session, report_type):
+    """Yield (class_arm_id, student, pdf_bytes, error) for every student in the given class arms.
+
+    All arms share one render stream, so a whole-school run keeps every
+    renderer busy across class boundaries instead of draining at the end
+    of each arm.
+    """
+    revisions, arm_ids, reports = {}, [], []
+    for class_arm_id in class_arm_ids:
+        # Revisions first: a change landing while contexts load then only causes an extra render
+        revisions.update(load_report_revisions(class_arm_id, term, session))
+        for report in load_class_report_contexts(class_arm_id, term, session, report_type).values():
+            arm_ids.append(class_arm_id)
+            reports.append(report)
+
+    for class_arm_id, (_, context), (pdf, error) in zip(arm_ids, reports, get_report_pdfs(reports, revisions)):
+        student = context['student']
+        if error:
+            print(f"❌ Error generating report for {student['full_name']}: {error}")
+        yield class_arm_id, student, pdf, error
+
+def write_class_reports(zf, class_arm_ids, term, session, report_type, folders=None, on_progress=None):
+    """Render every student's report for the given class arms into an open ZipFile.
+
+    `folders` maps a class arm id to the folder its PDFs go in; arms not in
+    it are written to the archive root. `on_progress(completed, failures)`
+    is called after each student. Returns (completed, failures) where
+    completed counts reports per class arm and failures is a list of
+    (class_arm_id, message) pairs.
+    """
+    folders = folders or {}
+    completed = defaultdict(int)
+    failures = []
 
-    for i, (student_id, avg) in enumerate(entries_sorted):
-        # Handle ties: if same score as previous student, same rank
-        if i > 0 and avg == entries_sorted[i - 1][1]:
-            rankings[student_id] = rankings[entries_sorted[i - 1][0]]
+    for class_arm_id, student, pdf, error in iter_report_pdfs(class_arm_ids, term, session, report_type):
+        if error:
+            failures.append((class_arm_id, f"{student['full_name']}: {error}"))
         else:
-            rankings[student_id] = position
-            
-        position += 1
+            zf.writestr(f"{folders.get(class_arm_id, '')}{student['full_name'].replace(' ', '_')}_report.pdf", pdf)
+            completed[class_arm_id] += 1
+        if on_progress:
+            on_progress(sum(completed.values()), failures)
+
+    return completed, failures
+
+class ZipStreamWriter(io.RawIOBase):
+    """Write-only, unseekable file for ZipFile that hands its output back in chunks.
+
+    ZipFile falls back to data descriptors on unseekable files, so each
+    entry can be sent as soon as it is written.
+    """
+
+    def __init__(self):
+        self._chunks = []
 
-    class_avg = sum(r["average"] for r in results)/len(results) if results else 0
-    total = sum(r["total_score"] or 0 for r in scores) if scores else 0
-    average = total / len(scores) if scores else 0
-    student_position = rankings.get(student["id"], None)
+    def writable(self):
+        return True
 
-    if class_level == "JSS":
-        position = student_position
-        grade = None
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def stream_class_reports_zip(class_arm_id, term, session, report_type):
+    """Yield a class arm's report ZIP piece by piece, one student's PDF at a time.
+
+    Students whose report failed are listed in errors.txt at the end of the archive.
+    """
+    stream = ZipStreamWriter()
+    failures = []
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as zf:
+        for _, student, pdf, error in iter_report_pdfs([class_arm_id], term, session, report_type):
+            if error:
+                failures.append(f"{student['full_name']}: {error}")
+                continue
+            zf.writestr(f"{student['full_name'].replace(' ', '_')}_report.pdf", pdf)
+            yield stream.drain()
+        if failures:
+            zf.writestr("errors.txt", "\n".join(failures))
+    yield stream.drain()
+
+REPORT_BOOKLET_STYLE = """
+    .report-booklet-entry { break-before: page; }
+    .report-booklet-entry:first-child { break-before: auto; }
+    h1, h2, h3, h4, h5, h6 { bookmark-level: none; }
+"""
+
+REPORT_BOOKLET_BOOKMARK_STYLE = """
+    .report-booklet-entry { bookmark-level: 1; bookmark-label: attr(data-student); }
+"""
+
+def build_report_booklet_html(reports, bookmarks=True):
+    """Join rendered reports into one HTML document, each student starting a new page.
+
+    A class arm's reports share one template, so the first report's <head>
+    styles the whole booklet and every student's <body> becomes a section.
+    WeasyPrint bookmarks each section with the student's name; Chromium
+    builds its outline from the report headings instead.
+    """
+    head, sections = "", []
+    for template_name, context in reports:
+        html = render_report_html(template_name, context)
+        if not head:
+            match = re.search(r"<head[^>]*>(.*?)</head>", html, re.S | re.I)
+            head = re.sub(r"<title>.*?</title>", "", match.group(1) if match else "", flags=re.S | re.I)
+        match = re.search(r"<body[^>]*>(.*)</body>", html, re.S | re.I)
+        body = match.group(1) if match else html
+        student_name = str(escape(context['student']['full_name']))
+        sections.append(f'<section class="report-booklet-entry" data-student="{student_name}">{body}</section>')
+
+    style = REPORT_BOOKLET_STYLE + (REPORT_BOOKLET_BOOKMARK_STYLE if bookmarks else "")
+    class_name = escape(reports[0][1]['class_name']) if reports else ""
+    return (f"<!DOCTYPE html><html><head>{head}<title>{class_name} Reports</title>"
+            f"<style>{style}</style></head><body>{''.join(sections)}</body></html>")
+
+def render_report_booklet(reports, bookmarks=True):
+    """One PDF holding every report in `reports`, rendered as a single document.
+
+    The booklet is cached under a hash of its students' report cache keys,
+    so an unchanged class is not printed again.
+    """
+    key = hashlib.sha256(json.dumps([
+        'booklet', bool(bookmarks),
+        [report_cache_key(template_name, context) for template_name, context in reports],
+    ]).encode()).hexdigest()
+    pdf = report_cache.get(key)
+    if pdf is not None:
+        return pdf
+
+    html = build_report_booklet_html(reports, bookmarks)
+    if app.config['REPORT_RENDERER'] == 'weasyprint':
+        pdf = get_pdf_process_pool().submit(html_to_pdf_weasyprint, html).result()
     else:
-        position = None
-        grade = grade_from_average(average)
+        pdf = get_browser_pool().render(html, outline=bookmarks)
+    report_cache.put(key, pdf)
+    return pdf
 
-    template_name = "full_term_report.html" if report_type == "full_term" else "half_term_report.html"
+def write_class_booklet(class_arm_id, term, session, report_type, bookmarks=True):
+    """Render a class arm's reports as one booklet PDF.
 
-    return render_template(template_name,
-                           student=student,
-                           class_name=student["class_name"],
-                           scores=scores,
-                           term=term,
-                           session=session,
-                           class_average=class_avg,
-                           position=position,
-                           grade=grade,
-                           skills=skills,
-                           average=average,
-                           report_type=report_type,
-                           attendance_summary=attendance_summary,
-                           assessment=assessment,
-                           year=datetime.now().year,
-                           current_date=datetime.now().strftime("%Y-%m-%d"))
+    Returns (pdf_bytes, student_count); pdf_bytes is None when the arm has
+    no students.
+    """
+    reports = list(load_class_report_contexts(class_arm_id, term, session, report_type).values())
+    if not reports:
+        return None, 0
+    return render_report_booklet(reports, bookmarks), len(reports)
+
+# -------------------------
+# Background report jobs
+# -------------------------
+def create_report_job(class_arm_id, term, session, report_type, output_format='zip', bookmarks=True,
+                      status='queued'):
+    """Record a report batch; class_arm_id None covers every class arm.
+
+    output_format 'zip' gives one PDF per student, 'booklet' one PDF per class arm.
+    """
+    db = get_db()
+    cursor = db.cursor()
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute("""
+        INSERT INTO report_jobs (class_arm_id, term, session, report_type, output_format, bookmarks,
+                                 status, created_at, started_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (class_arm_id, term, session, report_type, output_format, int(bool(bookmarks)),
+          status, now, now if status == 'running' else None))
+    db.commit()
+    return cursor.lastrowid
+
+def enqueue_report_job(class_arm_id, term, session, report_type, output_format='zip', bookmarks=True):
+    """Queue a report batch for the background worker; see create_report_job."""
+    job_id = create_report_job(class_arm_id, term, session, report_type, output_format, bookmarks)
+    start_report_worker()
+    _report_job_wakeup.set()
+    return job_id
+
+def recover_stale_report_jobs(cursor):
+    """Requeue (or fail, once out of attempts) running jobs whose worker stopped reporting."""
+    now = datetime.now()
+    cutoff = (now - timedelta(seconds=app.config['REPORT_JOB_STALE_SECONDS'])).strftime("%Y-%m-%d %H:%M:%S")
+    stale = "status = 'running' AND COALESCE(heartbeat_at, started_at) < ?"
+    cursor.execute(f"""
+        UPDATE report_jobs
+        SET status = 'failed', finished_at = ?,
+            errors = '["Job error: the worker stopped while running this job"]'
+        WHERE {stale} AND attempts >= ?
+    """, (now.strftime("%Y-%m-%d %H:%M:%S"), cutoff, app.config['REPORT_JOB_MAX_ATTEMPTS']))
+    failed = cursor.rowcount
+    cursor.execute(f"""
+        UPDATE report_jobs SET status = 'queued', completed = 0, failed = 0
+        WHERE {stale}
+    """, (cutoff,))
+    if failed or cursor.rowcount:
+        print(f"♻️ Recovered stale report jobs: {cursor.rowcount} requeued, {failed} failed")
+
+def claim_report_job():
+    """Atomically move the oldest queued job to running; returns its row or None.
+
+    Jobs left running by a worker that died are recovered first.
+    """
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        recover_stale_report_jobs(cursor)
+        job = cursor.execute("""
+            SELECT * FROM report_jobs WHERE status = 'queued' ORDER BY id LIMIT 1
+        """).fetchone()
+        if job:
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            cursor.execute("""
+                UPDATE report_jobs SET status = 'running', started_at = ?, heartbeat_at = ?, attempts = attempts + 1
+                WHERE id = ?
+            """, (now, now, job['id']))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return job
+
+def get_report_class_arms(class_arm_id=None):
+    """Class arms a report job covers, in school order; every arm when class_arm_id is None."""
+    db = get_db()
+    cursor = db.cursor()
+    query = """
+        SELECT a.id, c.name || ' ' || a.arm AS class_name
+        FROM class_arms a
+        JOIN classes c ON a.class_id = c.id
+    """
+    if class_arm_id:
+        cursor.execute(query + " WHERE a.id = ?", (class_arm_id,))
+    else:
+        cursor.execute(query + " ORDER BY c.id, a.arm")
+    return cursor.fetchall()
+
+def load_missing_scores(class_arm_ids, term, session, report_type):
+    """Compulsory subjects without a score, as {class_arm_id: {student_name: [subject names]}}."""
+    db = get_db()
+    cursor = db.cursor()
+    placeholders = ",".join("?" * len(class_arm_ids))
+    cursor.execute(f"""
+        SELECT DISTINCT sc.class_arm_id, s.full_name, sub.name AS subject_name
+        FROM student_classes sc
+        JOIN students s ON s.id = sc.student_id
+        JOIN class_subject_requirements csr
+            ON csr.class_arm_id = sc.class_arm_id AND csr.is_compulsory = 1
+        JOIN subjects sub ON sub.id = csr.subject_id
+        WHERE sc.session = ? AND sc.class_arm_id IN ({placeholders})
+          AND NOT EXISTS (
+              SELECT 1 FROM scores x
+              WHERE x.student_id = s.id AND x.subject_id = csr.subject_id
+                AND x.term = ? AND x.session = ? AND x.report_type = ?
+          )
+        ORDER BY sc.class_arm_id, s.full_name, sub.name
+    """, (session, *class_arm_ids, term, session, report_type))
+
+    missing = defaultdict(lambda: defaultdict(list))
+    for row in cursor.fetchall():
+        missing[row['class_arm_id']][row['full_name']].append(row['subject_name'])
+    return missing
+
+def build_report_manifest(arms, folders, term, session, report_type, student_counts, completed, failures):
+    """Summary of a whole-school run: per class, reports written, failures and missing scores."""
+    missing = load_missing_scores([arm['id'] for arm in arms], term, session, report_type)
+    failed = defaultdict(list)
+    for class_arm_id, message in failures:
+        failed[class_arm_id].append(message)
+
+    classes = [{
+        'class_arm_id': arm['id'],
+        'class_name': arm['class_name'],
+        'folder': folders[arm['id']],
+        'students': student_counts[arm['id']],
+        'reports': completed.get(arm['id'], 0),
+        'failed': failed[arm['id']],
+        'missing_scores': [{'student': name, 'subjects': subjects}
+                           for name, subjects in missing[arm['id']].items()],
+    } for arm in arms]
+
+    return {
+        'term': term,
+        'session': session,
+        'report_type': report_type,
+        'generated_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'totals': {
+            'classes': len(arms),
+            'students': sum(student_counts.values()),
+            'reports': sum(completed.values()),
+            'failed': len(failures),
+            'students_missing_scores': sum(len(students) for students in missing.values()),
+        },
+        'errors': failed[None],
+        'classes': classes,
+    }
+
+def run_report_job(job):
+    db = get_db()
+    cursor = db.cursor()
+    job_id = job['id']
+    term, session, report_type = job['term'], job['session'], job['report_type']
+    school = not job['class_arm_id']
+
+    arms = get_report_class_arms(job['class_arm_id'])
+    student_counts = {arm['id']: len(get_class_report_students(arm['id'], session)) for arm in arms}
+    cursor.execute("UPDATE report_jobs SET total = ? WHERE id = ?", (sum(student_counts.values()), job_id))
+    db.commit()
+
+    # Whole-school archives get one folder per class, named after it
+    folders = {arm['id']: f"{secure_filename(arm['class_name'])}/" for arm in arms} if school else {}
+    safe_session = session.replace("/", "_")
+    scope = "school" if school else f"class_{job['class_arm_id']}"
+    booklet = job['output_format'] == 'booklet'
+    extension = "pdf" if booklet and not school else "zip"
+    output_path = os.path.join(app.config['REPORT_OUTPUT_FOLDER'],
+                               f"job{job_id}_{scope}_term{term}_{safe_session}_reports.{extension}")
+
+    completed, failures = {}, []
+
+    def on_progress(done, job_failures):
+        # Doubles as the heartbeat that keeps the job from being recovered as stale
+        cursor.execute("UPDATE report_jobs SET completed = ?, failed = ?, heartbeat_at = ? WHERE id = ?",
+                       (done, len(job_failures), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job_id))
+        db.commit()
+
+    try:
+        if booklet and not school:
+            pdf, completed[job['class_arm_id']] = write_class_booklet(job['class_arm_id'], term, session,
+                                                                      report_type, bookmarks=job['bookmarks'])
+            if pdf is None:
+                raise ValueError("no students found for this class/year")
+            with open(output_path, 'wb') as f:
+                f.write(pdf)
+        else:
+            with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as zf:
+                if booklet:
+                    for arm in arms:
+                        # One class failing should not stop an unattended school run
+                        try:
+                            pdf, completed[arm['id']] = write_class_booklet(arm['id'], term, session, report_type,
+                                                                            bookmarks=job['bookmarks'])
+                        except Exception as e:
+                            failures.append((arm['id'], f"{arm['class_name']} booklet: {e}"))
+                            pdf = None
+                        if pdf:
+                            zf.writestr(f"{folders[arm['id']]}{secure_filename(arm['class_name'])}_reports.pdf", pdf)
+                        on_progress(sum(completed.values()), failures)
+                else:
+                    completed, failures = write_class_reports(zf, [arm['id'] for arm in arms], term, session,
+                                                              report_type, folders=folders, on_progress=on_progress)
+                if school:
+                    manifest = build_report_manifest(arms, folders, term, session, report_type,
+                                                     student_counts, completed, failures)
+                    zf.writestr("manifest.json", json.dumps(manifest, indent=2))
+        status = 'done'
+    except Exception as e:
+        failures.append((None, f"Job error: {e}"))
+        status = 'failed'
+
+    finish_report_job(job_id, status, sum(completed.values()), [message for _, message in failures], output_path)
+
+def finish_report_job(job_id, status, completed, failures, output_path):
+    db = get_db()
+    db.execute("""
+        UPDATE report_jobs
+        SET status = ?, completed = ?, failed = ?, errors = ?, output_path = ?, finished_at = ?
+        WHERE id = ?
+    """, (status, completed, len(failures), json.dumps(failures), output_path,
+          datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job_id))
+    db.commit()
+
+def report_worker_loop(stop_event=None):
+    """Run queued report jobs until stop_event is set."""
+    with app.app_context():
+        while not (stop_event and stop_event.is_set()):
+            job = claim_report_job()
+            if job:
+                print(f"🧾 Running report job {job['id']}")
+                try:
+                    run_report_job(job)
+                except Exception as e:
+                    print(f"❌ Report job {job['id']} failed: {e}")
+                    db = get_db()
+                    db.rollback()
+                    db.execute("""
+                        UPDATE report_jobs SET status = 'failed', errors = ?, finished_at = ? WHERE id = ?
+                    """, (json.dumps([f"Job error: {e}"]), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job['id']))
+                    db.commit()
+                continue
+            _report_job_wakeup.wait(app.config['REPORT_JOB_POLL_SECONDS'])
+            _report_job_wakeup.clear()
+
+_report_job_wakeup = threading.Event()
+_report_worker = None
+_report_worker_stop = threading.Event()
+
+def start_report_worker():
+    """Start this worker process's background job runner if it is not running."""
+    global _report_worker
+    with _browser_pool_lock:
+        if _report_worker is None or not _report_worker.is_alive():
+            _report_worker = threading.Thread(target=report_worker_loop, args=(_report_worker_stop,),
+                                              name="report-jobs", daemon=True)
+            _report_worker.start()
+
+@app.cli.command("report-worker")
+def report_worker_command():
+    """Run queued report jobs in the foreground."""
+    report_worker_loop()
+
+@app.cli.command("school-reports")
+@click.option("--term", type=int, default=None, help="Term number; defaults to the current term.")
+@click.option("--session", "session_name", default=None, help="Session such as 2025/2026; defaults to the current session.")
+@click.option("--report-type", type=click.Choice(['full_term', 'half_term']), default='full_term')
+@click.option("--format", "output_format", type=click.Choice(['zip', 'booklet']), default='zip',
+              help="One PDF per student, or one booklet PDF per class.")
+@click.option("--no-bookmarks", is_flag=True, help="Leave student bookmarks out of booklets.")
+@click.option("--workers", type=int, default=os.cpu_count() or 1, show_default=True,
+              help="Reports rendered at once.")
+def school_reports_command(term, session_name, report_type, output_format, no_bookmarks, workers):
+    """Generate reports for every class arm into one archive, e.g. overnight."""
+    # Pools are created on first render, so this sizes them for the whole run
+    app.config['REPORT_RENDER_WORKERS'] = app.config['REPORT_BROWSER_POOL_SIZE'] = workers
+    term = term or get_current_term()
+    session_name = session_name or get_current_session()
+
+    job_id = create_report_job(None, term, session_name, report_type, output_format,
+                               bookmarks=not no_bookmarks, status='running')
+    print(f"🧾 Report job {job_id}: all classes, term {term} {session_name} ({report_type}, {output_format})")
+    run_report_job(get_report_job(job_id))
+
+    job = get_report_job(job_id)
+    print(f"{'✅' if job['status'] == 'done' else '❌'} {job['status']}: "
+          f"{job['completed']}/{job['total']} reports, {job['failed']} failed")
+    print(f"📦 {job['output_path']}")
+
+def report_job_status(job):
+    return {
+        'id': job['id'],
+        'class_arm_id': job['class_arm_id'],
+        'term': job['term'],
+        'session': job['session'],
+        'report_type': job['report_type'],
+        'output_format': job['output_format'],
+        'status': job['status'],
+        'total': job['total'],
+        'completed': job['completed'],
+        'failed': job['failed'],
+        'errors': json.loads(job['errors']) if job['errors'] else [],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+        'download_url': url_for('download_report_job', job_id=job['id']) if job['status'] == 'done' else None,
+    }
+
+def get_report_job(job_id):
+    job = get_db().execute("SELECT * FROM report_jobs WHERE id = ?", (job_id,)).fetchone()
+    if not job:
+        abort(404, description="Report job not found")
+    return job
+
+@app.route('/report-jobs', methods=['POST'])
+def submit_report_job():
+    # No class arm, or 'all', queues the whole school
+    class_arm_id = request.form.get('class_arm_id', type=int)
+    if class_arm_id is None and request.form.get('class_arm_id') not in (None, '', 'all'):
+        return render_template("error.html", message="Class arm not found.")
+    term = request.form.get('term', type=int)
+    session = request.form.get('session')
+    report_type = request.form.get('report_type', 'full_term')
+    output_format = request.form.get('output_format', 'zip')
+
+    if not term or not session:
+        return render_template("error.html", message="Missing required fields.")
+    if report_type not in ('half_term', 'full_term') or output_format not in ('zip', 'booklet'):
+        return render_template("error.html", message="Invalid report type or output format.")
+    if class_arm_id is not None and not get_report_class_arms(class_arm_id):
+        return render_template("error.html", message="Class arm not found.")
+
+    job_id = enqueue_report_job(class_arm_id, term, session, report_type, output_format,
+                                bookmarks=bool(request.form.get('bookmarks')))
+    return redirect(url_for('report_job_page', job_id=job_id))
+
+@app.route('/report-jobs/<int:job_id>')
+def report_job_page(job_id):
+    job = get_report_job(job_id)
+    if job['status'] in ('queued', 'running'):
+        # Make sure some runner in this process will pick it up, or recover
+        # it if the worker running it has died
+        start_report_worker()
+    return render_template('report_job.html', job=report_job_status(job))
+
+@app.route('/report-jobs/<int:job_id>/status')
+def report_job_progress(job_id):
+    return jsonify(report_job_status(get_report_job(job_id)))
+
+@app.route('/report-jobs/<int:job_id>/download')
+def download_report_job(job_id):
+    job = get_report_job(job_id)
+    if job['status'] != 'done' or not job['output_path'] or not os.path.exists(job['output_path']):
+        abort(404, description="Report archive is not ready")
+    mimetype = "application/pdf" if job['output_path'].endswith('.pdf') else "application/zip"
+    return send_file(job['output_path'], as_attachment=True,
+                     download_name=os.path.basename(job['output_path']).split('_', 1)[1],
+                     mimetype=mimetype)
 
 @app.route('/download-student-template')
 def download_student_template():
@@ -2240,6 +4434,12 @@ def admin_dashboard():
     """
     students = cursor.execute(student_query, base_params_list + report_params).fetchall()
 
+    # Class positions (all arms combined) need a single term and session
+    positions = {}
+    if term and session:
+        positions = {row['student_id']: row
+                     for row in rank_students('class', int(term), session, report_type or 'full_term')}
+
     # 2. Class averages
     class_avg_query = f"""
         SELECT 
@@ -2290,11 +4490,15 @@ def admin_dashboard():
         AVG(avg_score) AS school_average,
         SUM(CASE WHEN avg_score >= 70 THEN 1 ELSE 0 END) AS above_70,
         SUM(CASE WHEN avg_score < 70 THEN 1 ELSE 0 END) AS below_70,
-        (SELECT COUNT(*) FROM scores sc WHERE {base_where} AND sc.report_type = ? AND sc.approved = 1) AS approved_scores,
-        (SELECT COUNT(*) FROM scores sc WHERE {base_where} AND sc.report_type = ?) AS total_scores
+        (SELECT COUNT(*) FROM scores sc
+         JOIN student_classes x ON sc.student_id = x.student_id AND sc.class_arm_id = x.class_arm_id
+         WHERE {base_where} AND sc.report_type = ? AND sc.approved = 1) AS approved_scores,
+        (SELECT COUNT(*) FROM scores sc
+         JOIN student_classes x ON sc.student_id = x.student_id AND sc.class_arm_id = x.class_arm_id
+         WHERE {base_where} AND sc.report_type = ?) AS total_scores
     FROM student_averages;
     """
-    overall_stats = cursor.execute(overall_query, base_params_list + [report_type, report_type, report_type]).fetchone()
+    overall_stats = cursor.execute(overall_query, (base_params_list + [report_type]) * 3).fetchone()
 
     # 5. Prepare chart data
     # Top 10 students (for bar/line chart)
@@ -2320,6 +4524,7 @@ def admin_dashboard():
         "admin_dashboard.html",
         classes=classes,                    # for dropdown
         students=students,                  # full list or paginated
+        positions=positions,                # {student_id: ranking row} when term and session are set
         class_averages=class_averages,      # table of class averages
         overall_stats=overall_stats,        # KPIs: total students, school avg, etc.
         gender_performance=gender_performance,
@@ -2333,6 +4538,11 @@ def admin_dashboard():
         # Optional: add more chart data here
     )
 
+@app.route("/admin/db-stats")
+def db_stats():
+    """Connection counters for this worker process."""
+    return jsonify(db_connections.stats())
+
 @app.route("/admin/students")
 def admin_students():
     db = get_db()
@@ -2728,7 +4938,7 @@ def bulk_assessments(class_arm_id, term, session):
     
     # Get class information
     cursor.execute("""
-        SELECT c.name AS class_name, a.arm
+        SELECT c.name AS class_name, a.arm, a.class_id, c.level
         FROM class_arms a
         JOIN classes c ON a.class_id = c.id
         WHERE a.id = ?
@@ -2745,24 +4955,19 @@ def bulk_assessments(class_arm_id, term, session):
     """, (class_arm_id, session))
     students = cursor.fetchall()
     
-    # ---- get student averages -----------------------------------------
-    cursor.execute("""
-        SELECT 
-            s.id AS student_id,
-            ROUND(AVG(sc.total_score), 2) AS average_score
-        FROM students s
-        JOIN scores sc ON s.id = sc.student_id
-        WHERE sc.class_arm_id = ?
-        AND sc.term = ?
-        AND sc.session = ?
-        AND sc.report_type = 'full_term'
-        GROUP BY s.id
-    """, (class_arm_id, term, session))
+    # ---- get student averages and positions ---------------------------
+    rankings = {}
+    if class_info:
+        scope = app.config['REPORT_POSITION_SCOPE']
+        rankings = get_class_rankings(scope, class_info['class_id'] if scope == 'class' else class_arm_id,
+                                      term, session, 'full_term')
 
     averages = {
-        row['student_id']: row['average_score']
-        for row in cursor.fetchall()
+        student_id: round(row['average'], 2)
+        for student_id, row in rankings.items()
     }
+    # Positions are only printed on junior reports
+    positions = rankings if class_info and class_info['level'] == 'JSS' else {}
 
     # Get existing assessment data
     assessment_data = {}
@@ -2797,6 +5002,7 @@ def bulk_assessments(class_arm_id, term, session):
                          class_info=class_info,
                          students=students,
                          averages=averages,
+                         positions=positions,
                          assessment_data=assessment_data,
                          class_arm_id=class_arm_id,
                          principal_comments=principal_comments,
@@ -3018,11 +5224,13 @@ def student_photos():
 def generate_test_results():
     """
     Generate test full-term result Excel files for all subjects in a class.
-    Uses real student names from the DB.
+    Uses real student names from the DB. With ?format=workbook a single
+    workbook is returned instead, with a sheet per subject.
     """
     class_arm_id = request.args.get("class_arm_id", type=int)
     session = request.args.get("session")
     term = request.args.get("term", type=int)
+    as_workbook = request.args.get("format") == "workbook"
 
     if not all([class_arm_id, session, term]):
         return "Missing parameters: class_arm_id, session, term", 400
@@ -3056,6 +5264,34 @@ def generate_test_results():
     if not subjects:
         return "No subjects found for this class", 404
 
+    def random_results():
+        data = {
+            "full_name": [s["full_name"] for s in students],
+            "ca1": np.random.randint(0, 6, len(students)),
+            "ca2": np.random.randint(0, 6, len(students)),
+            "ca3": np.random.randint(0, 6, len(students)),
+            "ca4": np.random.randint(0, 6, len(students)),
+            "exam": np.random.randint(40, 81, len(students)),
+        }
+
+        df = pd.DataFrame(data)
+        df["total"] = df["ca1"] + df["ca2"] + df["ca3"] + df["ca4"] + df["exam"]
+        return df
+
+    if as_workbook:
+        # One sheet per subject, in the shape /upload-results-workbook reads
+        output = BytesIO()
+        with pd.ExcelWriter(output, engine="openpyxl") as writer:
+            for subject in subjects:
+                random_results().to_excel(writer, sheet_name=subject["name"][:31], index=False)
+        output.seek(0)
+        return send_file(
+            output,
+            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            as_attachment=True,
+            download_name=f"class_{class_arm_id}_full_term_test_results.xlsx"
+        )
+
     # Prepare ZIP file in memory
     zip_buffer = BytesIO()
     import zipfile
@@ -3066,17 +5302,7 @@ def generate_test_results():
             subject_name = subject["name"].replace(" ", "_")
 
             # Generate random scores
-            data = {
-                "full_name": [s["full_name"] for s in students],
-                "ca1": np.random.randint(0, 6, len(students)),
-                "ca2": np.random.randint(0, 6, len(students)),
-                "ca3": np.random.randint(0, 6, len(students)),
-                "ca4": np.random.randint(0, 6, len(students)),
-                "exam": np.random.randint(40, 81, len(students)),
-            }
-
-            df = pd.DataFrame(data)
-            df["total"] = df["ca1"] + df["ca2"] + df["ca3"] + df["ca4"] + df["exam"]
+            df = random_results()
 
             # Write to Excel (in memory)
             output = BytesIO()
@@ -0,0 +1,55 @@
+import importlib
+import os
+import sys
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """The app module, imported from a scratch directory.
+
+    Importing app creates its database and upload folders relative to the
+    working directory, so tests never touch a real school_results.db.
+    """
+    os.chdir(tmp_path_factory.mktemp("app"))
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    return importlib.import_module("app")
+
+
+
+@pytest.fixture
+def db(app_module):
+    """A connection to the scratch database inside an app context."""
+    with app_module.app.app_context():
+        yield app_module.get_db()
+
+
+@pytest.fixture
+def class_arm(db):
+    """(class_arm_id, session): the first class arm in a session no other test uses."""
+    arm_id = db.execute("SELECT id FROM class_arms ORDER BY id LIMIT 1").fetchone()["id"]
+    return arm_id, f"test-{uuid.uuid4().hex[:8]}"
+
+
+@pytest.fixture
+def enrol(db, class_arm):
+    """Register students by name in `class_arm` for term 1; returns their ids in order."""
+    arm_id, session = class_arm
+
+    def enrol(names, term=1):
+        ids = []
+        for name in names:
+            cursor = db.execute("INSERT INTO students (reg_number, full_name, age, gender) VALUES (?, ?, 12, 'Male')",
+                                (f"{session}-{uuid.uuid4().hex[:8]}", name))
+            db.execute("INSERT INTO student_classes (student_id, class_arm_id, session, term) VALUES (?, ?, ?, ?)",
+                       (cursor.lastrowid, arm_id, session, term))
+            ids.append(cursor.lastrowid)
+        db.commit()
+        return ids
+
+    return enrol
@@ -0,0 +1,86 @@
+from datetime import datetime
+
+
+def add_scores(db, class_arm, totals, term=1):
+    """Give each student one score per subject: totals maps student_id to a list of totals."""
+    arm_id, session = class_arm
+    subjects = [row["subject_id"] for row in db.execute(
+        "SELECT subject_id FROM class_subject_requirements WHERE class_arm_id = ? ORDER BY subject_id LIMIT 2",
+        (arm_id,))]
+    for student_id, student_totals in totals.items():
+        for subject_id, total in zip(subjects, student_totals):
+            db.execute("""
+                INSERT INTO scores (student_id, subject_id, class_arm_id, term, session,
+                                    total_score, report_type, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, 'full_term', ?)
+            """, (student_id, subject_id, arm_id, term, session, total,
+                  datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    db.commit()
+    return subjects
+
+
+def test_tied_averages_share_rank_and_dense_rank(app_module, db, class_arm, enrol):
+    arm_id, session = class_arm
+    ada, bola, chi, dayo = enrol(["Ada", "Bola", "Chi", "Dayo"])
+    add_scores(db, class_arm, {ada: [80, 80], bola: [60, 80], chi: [75, 65], dayo: [50, 70]})
+
+    rows = app_module.rank_students("arm", 1, session, "full_term", scope_id=arm_id)
+
+    assert [(row["student_id"], row["average"], row["position"], row["dense_position"]) for row in rows] == [
+        (ada, 80.0, 1, 1),
+        (bola, 70.0, 2, 2),
+        (chi, 70.0, 2, 2),
+        (dayo, 60.0, 4, 3),
+    ]
+    assert {row["class_average"] for row in rows} == {70.0}
+    assert {row["student_count"] for row in rows} == {4}
+
+
+def test_students_without_scores_are_not_ranked(app_module, db, class_arm, enrol):
+    arm_id, session = class_arm
+    ada, _ = enrol(["Ada", "Bola"])
+    add_scores(db, class_arm, {ada: [50, 60]})
+
+    rows = app_module.rank_students("arm", 1, session, "full_term", scope_id=arm_id)
+
+    assert [(row["student_id"], row["position"], row["student_count"]) for row in rows] == [(ada, 1, 1)]
+
+
+def test_stored_rankings_are_rebuilt_after_a_score_changes(app_module, db, class_arm, enrol):
+    arm_id, session = class_arm
+    ada, bola = enrol(["Ada", "Bola"])
+    subjects = add_scores(db, class_arm, {ada: [80, 80], bola: [70, 70]})
+
+    rankings = app_module.get_class_rankings("arm", arm_id, 1, session, "full_term")
+    assert (rankings[ada]["position"], rankings[bola]["position"]) == (1, 2)
+
+    db.execute("UPDATE scores SET total_score = 95 WHERE student_id = ? AND subject_id = ?", (bola, subjects[0]))
+    db.commit()
+
+    rankings = app_module.get_class_rankings("arm", arm_id, 1, session, "full_term")
+    assert (rankings[ada]["position"], rankings[bola]["position"]) == (2, 1)
+
+
+def test_empty_scope_is_built_once(app_module, db, class_arm):
+    arm_id, session = class_arm
+
+    assert app_module.get_class_rankings("arm", arm_id, 1, session, "full_term") == {}
+    changes = db.total_changes
+    assert app_module.get_class_rankings("arm", arm_id, 1, session, "full_term") == {}
+    assert db.total_changes == changes
+
+
+def test_moving_a_score_to_another_subject_invalidates_subject_rankings(app_module, db, class_arm, enrol):
+    arm_id, session = class_arm
+    ada, bola = enrol(["Ada", "Bola"])
+    first, second = add_scores(db, class_arm, {ada: [80, 60], bola: [70]})
+
+    rankings = app_module.get_subject_rankings("arm", arm_id, 1, session, "full_term")
+    assert set(rankings[bola]) == {first}
+
+    db.execute("UPDATE scores SET subject_id = ? WHERE student_id = ? AND subject_id = ?", (second, bola, first))
+    db.commit()
+
+    rankings = app_module.get_subject_rankings("arm", arm_id, 1, session, "full_term")
+    assert set(rankings[bola]) == {second}
+    assert rankings[bola][second]["position"] == 1
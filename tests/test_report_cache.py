@@ -0,0 +1,59 @@
+import os
+
+
+def make_cache(app_module, tmp_path, max_bytes):
+    return app_module.ReportCache(str(tmp_path / "cache"), max_bytes)
+
+
+def put_at(cache, key, pdf, mtime):
+    """Store a PDF as if it had last been used at `mtime`."""
+    cache.put(key, pdf)
+    os.utime(cache.path(key), (mtime, mtime))
+
+
+def test_get_returns_stored_pdf_and_counts_hits(app_module, tmp_path):
+    cache = make_cache(app_module, tmp_path, 1000)
+    cache.put("a" * 64, b"%PDF-a")
+
+    assert cache.contains("a" * 64)
+    assert cache.get("a" * 64) == b"%PDF-a"
+    assert cache.get("b" * 64) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_is_evicted_first(app_module, tmp_path):
+    cache = make_cache(app_module, tmp_path, 100)
+    a, b, c, d = ("a" * 64, "b" * 64, "c" * 64, "d" * 64)
+    put_at(cache, a, b"a" * 30, 1000)
+    put_at(cache, b, b"b" * 30, 2000)
+    put_at(cache, c, b"c" * 30, 3000)
+
+    # Reading a makes b the least recently used
+    assert cache.get(a) is not None
+    cache.put(d, b"d" * 30)
+
+    assert [cache.contains(key) for key in (a, b, c, d)] == [True, False, True, True]
+
+
+def test_eviction_trims_below_the_limit(app_module, tmp_path):
+    cache = make_cache(app_module, tmp_path, 100)
+    keys = [str(i) * 64 for i in range(5)]
+    for mtime, key in enumerate(keys[:4], start=1000):
+        put_at(cache, key, b"x" * 25, mtime)
+
+    cache.put(keys[4], b"x" * 25)
+
+    # 125 bytes is over the limit; the oldest go until at most 90 bytes remain
+    assert [cache.contains(key) for key in keys] == [False, False, True, True, True]
+    assert sum(os.path.getsize(cache.path(key)) for key in keys if cache.contains(key)) <= 90
+
+
+def test_rewriting_a_key_does_not_count_it_twice(app_module, tmp_path):
+    cache = make_cache(app_module, tmp_path, 100)
+    a, b = "a" * 64, "b" * 64
+    put_at(cache, a, b"a" * 40, 1000)
+    for _ in range(3):
+        cache.put(b, b"b" * 40)
+
+    assert cache.contains(a)
+    assert cache._size == 80
@@ -0,0 +1,77 @@
+import pandas as pd
+
+
+def score_frame(rows, columns=("full_name", "ca1_score", "ca2_score", "ca3_score", "ca4_score", "exam_score")):
+    return pd.DataFrame(rows, columns=list(columns), dtype=object)
+
+
+def test_full_term_rejects_out_of_range_and_non_numeric_scores(app_module):
+    df = score_frame([
+        ["Ada Obi", 5, 5, 5, 5, 80],
+        ["Bola Ade", 6, 1, 1, 1, 10],
+        ["Chi Eze", "x", 1, 1, 1, 10],
+        ["Dayo Ola", 1, 1, 1, 1, -3],
+        ["Efe Uche", 2, 2, 2, 2, 40],
+    ])
+
+    scores, errors = app_module.validate_score_frame(df, "full_term")
+
+    assert errors == [
+        "Bola Ade: CA1 6 (must be 0-5)",
+        "Chi Eze: CA1 x (must be 0-5)",
+        "Dayo Ola: Exam -3 (must be 0-80)",
+    ]
+    assert scores["full_name"].tolist() == ["Ada Obi", "Efe Uche"]
+    assert scores["row"].tolist() == [2, 6]
+    assert scores["total_score"].tolist() == [100.0, 48.0]
+
+
+def test_full_term_skips_rows_with_blank_scores(app_module):
+    df = score_frame([
+        ["Ada Obi", 1, 1, 1, 1, 10],
+        ["Bola Ade", None, None, None, None, None],
+        ["Chi Eze", 1, "", 1, 1, 10],
+        ["Dayo Ola", 1, 1, 1, 1, 10],
+    ])
+
+    scores, errors = app_module.validate_score_frame(df, "full_term")
+
+    assert errors == []
+    assert scores["full_name"].tolist() == ["Ada Obi", "Dayo Ola"]
+    assert scores["row"].tolist() == [2, 5]
+
+
+def test_empty_names_are_reported_by_spreadsheet_row(app_module):
+    df = score_frame([
+        ["Ada Obi", 1, 1, 1, 1, 10],
+        ["", 1, 1, 1, 1, 10],
+        [None, 9, 1, 1, 1, 10],
+        ["  ", 1, 1, 1, 1, 10],
+    ])
+
+    # A later chunk: its first row is row 102 of the sheet
+    scores, errors = app_module.validate_score_frame(df, "full_term", first_row=102)
+
+    assert errors == [
+        "Row 103: Empty or invalid full_name",
+        "Row 104: Empty or invalid full_name",
+        "Row 105: Empty or invalid full_name",
+    ]
+    assert scores["row"].tolist() == [102]
+
+
+def test_half_term_counts_blanks_as_zero(app_module):
+    df = score_frame([
+        ["Ada Obi", 4, None],
+        ["Bola Ade", 7, 2],
+        ["Chi Eze", "abc", 1],
+    ], columns=("full_name", "ca1_score", "ca2_score"))
+
+    scores, errors = app_module.validate_score_frame(df, "half_term")
+
+    assert errors == [
+        "Invalid CA1 score for Bola Ade: 7. Must be between 0-5",
+        "Invalid CA1 score for Chi Eze: abc. Must be between 0-5",
+    ]
+    assert scores["full_name"].tolist() == ["Ada Obi"]
+    assert scores[["ca1_score", "ca2_score", "total_score"]].values.tolist() == [[4.0, 0.0, 4.0]]
@@ -0,0 +1,60 @@
+import pytest
+
+
+@pytest.fixture
+def name_index(app_module):
+    return app_module.StudentNameIndex([
+        {"id": 1, "full_name": "Oluwaseun Adeyemi"},
+        {"id": 2, "full_name": "Chioma Okeke"},
+        {"id": 3, "full_name": "Chioma Obi"},
+    ])
+
+
+@pytest.mark.parametrize("search, expected", [
+    ("oluwaseun  ADEYEMI", 1),
+    ("Adeyemi", 1),
+    ("Oluwasegun Adeyinka", 1),
+    ("ok", 2),
+])
+def test_single_match(name_index, search, expected):
+    student, candidates = name_index.match(search)
+
+    assert student["id"] == expected
+    assert candidates == []
+
+
+def test_close_but_unclear_name_suggests_one_candidate(name_index):
+    student, candidates = name_index.match("Seun Adeyemo")
+
+    assert student is None
+    assert [candidate["id"] for candidate in candidates] == [1]
+
+
+def test_shared_first_name_is_ambiguous(name_index):
+    student, candidates = name_index.match("Chioma")
+
+    assert student is None
+    assert sorted(candidate["id"] for candidate in candidates) == [2, 3]
+
+
+def report_lookup_message(app_module, class_arm, full_name):
+    arm_id, session = class_arm
+    response = app_module.app.test_client().post("/generate-reports", data={
+        "class_arm_id": str(arm_id), "term": "1", "session": session, "full_name": full_name})
+    return response.get_data(as_text=True).replace("&#39;", "'")
+
+
+def test_report_lookup_offers_did_you_mean(app_module, class_arm, enrol):
+    enrol(["Oluwaseun Adeyemi", "Chioma Okeke"])
+
+    message = report_lookup_message(app_module, class_arm, "Seun Adeyemo")
+
+    assert "No exact match for 'Seun Adeyemo'; did you mean Oluwaseun Adeyemi?" in message
+
+
+def test_report_lookup_lists_tied_students(app_module, class_arm, enrol):
+    enrol(["Chioma Okeke", "Chioma Obi"])
+
+    message = report_lookup_message(app_module, class_arm, "Chioma")
+
+    assert "More than one student could be 'Chioma'" in message
@@ -0,0 +1,40 @@
+import pandas as pd
+
+
+def test_register_is_saved_a_chunk_at_a_time(app_module, db, class_arm, tmp_path, monkeypatch):
+    # Reg numbers are built from a real "YYYY/YYYY" session
+    arm_id, _ = class_arm
+    session = "2031/2032"
+    db.execute("INSERT INTO students (reg_number, full_name) VALUES ('enrolled', 'Chi Eze')")
+    db.execute("INSERT INTO student_classes (student_id, class_arm_id, session, term) "
+               "SELECT id, ?, ?, 1 FROM students WHERE reg_number = 'enrolled'", (arm_id, session))
+    db.commit()
+
+    path = tmp_path / "register.xlsx"
+    pd.DataFrame({"Full Name": ["Ada Obi", "Bola Ade", "ada obi", "Chi Eze", "Dayo Ola"],
+                  "Gender": ["f", "m", "f", "m", "male"]}).to_excel(path, index=False)
+    monkeypatch.setitem(app_module.app.config, "UPLOAD_CHUNK_ROWS", 2)
+
+    errors, saved = app_module.process_student_upload(str(path), arm_id, session, 1)
+
+    assert errors == ["Duplicate in file skipped: ada obi", "Already exists skipped: Chi Eze"]
+    assert saved == 3
+    rows = db.execute("""
+        SELECT s.full_name, s.gender, s.reg_number FROM students s
+        JOIN student_classes sc ON sc.student_id = s.id
+        WHERE sc.class_arm_id = ? AND sc.session = ? AND s.reg_number != 'enrolled'
+        ORDER BY s.reg_number
+    """, (arm_id, session)).fetchall()
+    assert [(row["full_name"], row["gender"]) for row in rows] == [
+        ("Ada Obi", "Female"), ("Bola Ade", "Male"), ("Dayo Ola", "Male")]
+    assert [row["reg_number"][-3:] for row in rows] == ["001", "002", "003"]
+
+
+def test_missing_name_column_saves_nothing(app_module, db, class_arm, tmp_path):
+    arm_id, _ = class_arm
+    path = tmp_path / "register.csv"
+    path.write_text("Name,Gender\nAda Obi,f\n")
+
+    assert app_module.process_student_upload(str(path), arm_id, "2033/2034", 1) == (
+        ["Missing required column: full_name"], 0)
+    assert not db.in_transaction
@@ -0,0 +1,61 @@
+from io import BytesIO
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+
+def xlsx(rows):
+    workbook = Workbook()
+    for row in rows:
+        workbook.active.append(row)
+    buffer = BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def csv(rows):
+    return "\n".join(",".join("" if value is None else str(value) for value in row) for row in rows).encode() + b"\n"
+
+
+@pytest.mark.parametrize("make, filename", [(xlsx, "scores.xlsx"), (csv, "scores.csv")])
+def test_header_only_file_yields_one_empty_frame(app_module, make, filename):
+    frames = list(app_module.iter_upload_frames(make([["Full_Name", "CA1"]]), filename))
+
+    assert len(frames) == 1
+    assert frames[0].empty
+    assert list(frames[0].columns) == ["Full_Name", "CA1"]
+
+
+@pytest.mark.parametrize("make, filename", [(xlsx, "scores.xlsx"), (csv, "scores.csv")])
+def test_header_only_file_reports_missing_columns(app_module, make, filename):
+    scores, errors = app_module.parse_score_sheet(make([["Full_Name", "CA1"]]), "full_term", filename=filename)
+
+    assert scores is None
+    assert errors == ["Missing required columns: ca2_score, ca3_score, ca4_score, exam_score"]
+
+
+def test_workbook_blank_rows_inside_are_kept_and_trailing_ones_dropped(app_module):
+    rows = [["full_name", "ca1"], ["Ada", 1], [None, None], ["Bola", 2], [None, None], [None, None]]
+
+    frames = list(app_module.iter_upload_frames(xlsx(rows), "scores.xlsx"))
+    df = pd.concat(frames, ignore_index=True)
+
+    assert len(df) == 3
+    assert df.loc[[0, 2], "full_name"].tolist() == ["Ada", "Bola"]
+    assert df.iloc[1].isna().all()
+
+
+@pytest.mark.parametrize("make, filename", [(xlsx, "scores.xlsx"), (csv, "scores.csv")])
+def test_rows_are_read_in_chunks(app_module, make, filename):
+    rows = [["full_name", "ca1"]] + [[f"Student {i}", i % 5] for i in range(7)]
+
+    frames = list(app_module.iter_upload_frames(make(rows), filename, chunksize=3))
+
+    assert [len(frame) for frame in frames] == [3, 3, 1]
+    assert pd.concat(frames)["full_name"].tolist() == [f"Student {i}" for i in range(7)]
+
+
+def test_empty_workbook_yields_nothing(app_module):
+    assert list(app_module.iter_upload_frames(xlsx([]), "scores.xlsx")) == []
+    assert app_module.parse_score_sheet(xlsx([]), "full_term", filename="scores.xlsx") == (None, ["The sheet has no rows"])
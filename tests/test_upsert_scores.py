@@ -0,0 +1,67 @@
+import pandas as pd
+
+
+def frame(rows):
+    """Rows of (student_id, ca1, ca2) in the shape validate_score_frame returns for half-term sheets."""
+    return pd.DataFrame([{"row": i + 2, "full_name": f"Student {i}", "ca1_score": ca1, "ca2_score": ca2,
+                          "total_score": ca1 + ca2, "student_id": student_id}
+                         for i, (student_id, ca1, ca2) in enumerate(rows)])
+
+
+def saved_scores(db, session):
+    return db.execute("""
+        SELECT student_id, ca1_score, ca2_score, total_score, approved FROM scores
+        WHERE session = ? ORDER BY student_id
+    """, (session,)).fetchall()
+
+
+def subject(db, arm_id):
+    return db.execute("SELECT subject_id FROM class_subject_requirements WHERE class_arm_id = ? LIMIT 1",
+                      (arm_id,)).fetchone()["subject_id"]
+
+
+def test_existing_scores_are_updated_in_place(app_module, db, class_arm, enrol):
+    arm_id, session = class_arm
+    ada, bola = enrol(["Ada", "Bola"])
+    subject_id = subject(db, arm_id)
+
+    app_module.upsert_scores(frame([(ada, 1, 2), (bola, 3, 4)]), subject_id, arm_id, 1, session, "half_term")
+    db.execute("UPDATE scores SET approved = 1 WHERE session = ?", (session,))
+    db.commit()
+    ids = [row["id"] for row in db.execute("SELECT id FROM scores WHERE session = ? ORDER BY student_id", (session,))]
+
+    saved, failures = app_module.upsert_scores(frame([(ada, 5, 5)]), subject_id, arm_id, 1, session, "half_term")
+
+    assert (saved, failures) == (1, [])
+    assert [tuple(row) for row in saved_scores(db, session)] == [(ada, 5, 5, 10, 0), (bola, 3, 4, 7, 1)]
+    assert [row["id"] for row in db.execute("SELECT id FROM scores WHERE session = ? ORDER BY student_id",
+                                            (session,))] == ids
+
+
+def test_a_bad_row_is_retried_alone_and_reported(app_module, db, class_arm, enrol):
+    arm_id, session = class_arm
+    ada, bola = enrol(["Ada", "Bola"])
+    scores = frame([(ada, 1, 2), (None, 3, 3), (bola, 4, 4)])
+
+    saved, failures = app_module.upsert_scores(scores, subject(db, arm_id), arm_id, 1, session, "half_term")
+
+    assert saved == 2
+    assert len(failures) == 1
+    row, message = failures[0]
+    assert row.row == 3
+    assert "NOT NULL" in message
+    assert [(row["student_id"], row["total_score"]) for row in saved_scores(db, session)] == [(ada, 3), (bola, 8)]
+    assert not db.in_transaction
+
+
+def test_a_callers_transaction_is_left_open(app_module, db, class_arm, enrol):
+    arm_id, session = class_arm
+    (ada,) = enrol(["Ada"])
+
+    db.execute("BEGIN")
+    saved, _ = app_module.upsert_scores(frame([(ada, 1, 1)]), subject(db, arm_id), arm_id, 1, session, "half_term")
+    assert saved == 1
+    assert db.in_transaction
+    db.rollback()
+
+    assert saved_scores(db, session) == []